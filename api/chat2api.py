@@ -12,11 +12,23 @@ from sqlalchemy.orm import Session
 from typing import Optional
 
 from app import app, templates, security_scheme
+from api.files import image_resizer
+from api.tokens import tokenizer_registry, token_count_cache, tokenizer_pool
 from chatgpt.ChatService import ChatService
 from chatgpt.authorization import refresh_all_tokens
+from chatgpt.conversationSessions import conversation_sessions
+from chatgpt.hostSelector import host_selector
+from chatgpt.keepAlive import keep_alive_manager
+from chatgpt.uploadCache import upload_cache
+from utils import json_utils
+from utils.Client import client_pool
 from utils.Logger import logger
-from utils.configs import api_prefix, scheduled_refresh, authorization_list, pipeline_enable
+from utils.configs import api_prefix, scheduled_refresh, authorization_list, pipeline_enable, sse_coalesce_bytes, \
+    sse_coalesce_interval
+from utils.response_cache import response_cache
 from utils.retry import async_retry
+from utils.sse import coalesce_sse, guard_stream, close_stream, stream_tracker
+from utils.stream_buffer import resumable_streams, single_flight, StreamBuffer
 from utils.database import get_db, get_db_context
 from apps.token.operations import mark_token_as_error, get_available_token
 from apps.user.utils import decode_token
@@ -33,6 +45,18 @@ async def app_start():
                           kwargs={'force_refresh': True})
         scheduler.start()
         asyncio.get_event_loop().call_later(0, lambda: asyncio.create_task(refresh_all_tokens(force_refresh=False)))
+    logger.info(f"JSON backend: {json_utils.backend}")
+    tokenizer_registry.load()
+    client_pool.start()
+    await keep_alive_manager.start()
+
+
+@app.on_event("shutdown")
+async def app_stop():
+    await keep_alive_manager.stop()
+    await client_pool.close()
+    tokenizer_pool.close()
+    image_resizer.close()
 
 
 def get_api_token(db: Session):
@@ -120,11 +144,34 @@ def process_with_pipeline(func):
 @process_with_pipeline
 async def process(request_data, req_token, user=None):
     chat_service = await to_send_conversation(request_data, req_token)
-    await chat_service.prepare_send_conversation()
-    res = await chat_service.send_conversation()
+    try:
+        await chat_service.prepare_send_conversation()
+        res = await chat_service.send_conversation()
+    except BaseException:
+        # Hand the pooled clients back before async_retry runs another attempt
+        await chat_service.close_client()
+        raise
     return chat_service, res
 
 
+async def process_cached(request_data, req_token, user=None, cache_key=None):
+    chat_service, res = await async_retry(process, request_data, req_token, user)
+    if cache_key:
+        if isinstance(res, types.AsyncGeneratorType):
+            res = response_cache.record(cache_key, res)
+        else:
+            await response_cache.set(cache_key, res)
+    return chat_service, res
+
+
+def sse_response(res, on_abort=None, *cleanup):
+    if sse_coalesce_bytes > 0:
+        res = coalesce_sse(res, sse_coalesce_bytes, sse_coalesce_interval / 1000)
+    res = guard_stream(res, on_abort)
+    background = BackgroundTask(close_stream, res, *cleanup)
+    return StreamingResponse(res, media_type="text/event-stream", background=background)
+
+
 @app.post(f"/{api_prefix}/v1/chat/completions" if api_prefix else "/v1/chat/completions")
 async def send_conversation(request: Request, credentials: HTTPAuthorizationCredentials = Security(security_scheme), db: Session = Depends(get_db)):
     # 獲取請求中的 token（必須提供）
@@ -133,17 +180,43 @@ async def send_conversation(request: Request, credentials: HTTPAuthorizationCred
     # TODO: 目前先固定，未來每個 user 都有自己的 api-keys
     user = UserOperation.get_first_user(db)
 
+    last_event_id = request.headers.get("last-event-id")
+    if last_event_id and resumable_streams.enabled:
+        return sse_response(resumable_streams.resume(last_event_id, req_token))
+
     try:
         request_data = await request.json()
     except Exception:
         raise HTTPException(status_code=400, detail={"error": "Invalid JSON body"})
-    
-    chat_service, res = await async_retry(process, request_data, req_token, user)
+
+    cache_key = None
+    # Cached replies skip token verification, so only API keys may use them
+    if req_token in authorization_list and response_cache.is_enabled(request.headers):
+        cache_key = response_cache.key(req_token, request_data)
+        cached = await response_cache.get(cache_key)
+        if isinstance(cached, list):
+            return sse_response(response_cache.replay(cached))
+        if cached is not None:
+            return JSONResponse(cached, media_type="application/json")
+
+    if single_flight.enabled:
+        key = single_flight.key(req_token, request_data)
+        res = await single_flight.run(key, process_cached, request_data, req_token, user, cache_key, owner=req_token)
+        if isinstance(res, StreamBuffer):
+            return sse_response(res.relay(ids=resumable_streams.enabled))
+        return JSONResponse(res, media_type="application/json")
+
+    chat_service, res = await process_cached(request_data, req_token, user, cache_key)
     
     try:
         if isinstance(res, types.AsyncGeneratorType):
-            background = BackgroundTask(chat_service.close_client)
-            return StreamingResponse(res, media_type="text/event-stream", background=background)
+            if resumable_streams.enabled:
+                # The upstream is pumped by its own task and outlives this connection
+                buffer = resumable_streams.start(res, chat_service.close_client, req_token)
+                res, on_abort, cleanup = buffer.relay(), None, ()
+            else:
+                on_abort, cleanup = chat_service.abort, (chat_service.close_client,)
+            return sse_response(res, on_abort, *cleanup)
         else:
             background = BackgroundTask(chat_service.close_client)
             return JSONResponse(res, media_type="application/json", background=background)
@@ -159,6 +232,14 @@ async def send_conversation(request: Request, credentials: HTTPAuthorizationCred
         raise HTTPException(status_code=500, detail="Server error")
 
 
+@app.delete(f"/{api_prefix}/v1/response_cache" if api_prefix else "/v1/response_cache")
+async def purge_response_cache(credentials: HTTPAuthorizationCredentials = Security(security_scheme)):
+    if credentials.credentials not in authorization_list:
+        raise HTTPException(status_code=401, detail="Unauthorized: Invalid token")
+
+    return {"purged": await response_cache.purge()}
+
+
 @app.get(f"/{api_prefix}/v1/models" if api_prefix else "/v1/models")
 async def get_models(request: Request, credentials: HTTPAuthorizationCredentials = Security(security_scheme)):
     req_token = credentials.credentials
@@ -207,3 +288,23 @@ async def get_models(request: Request, credentials: HTTPAuthorizationCredentials
             }
         ]
     }
+
+
+@app.get(f"/{api_prefix}/v1/upstream/status" if api_prefix else "/v1/upstream/status")
+async def get_upstream_status(credentials: HTTPAuthorizationCredentials = Security(security_scheme)):
+    if credentials.credentials not in authorization_list:
+        raise HTTPException(status_code=401, detail="Unauthorized: Invalid token")
+
+    return {
+        "client_pool": client_pool.stats(),
+        "hosts": keep_alive_manager.status,
+        "routing": host_selector.get_stats(),
+        "token_cache": token_count_cache.stats(),
+        "streams": stream_tracker.stats(),
+        "resumable_streams": resumable_streams.stats(),
+        "single_flight": single_flight.stats(),
+        "response_cache": response_cache.stats(),
+        "conversations": conversation_sessions.stats(),
+        "upload_cache": upload_cache.stats(),
+        "image_resize": image_resizer.stats(),
+    }
@@ -1,33 +1,131 @@
+import asyncio
+import hashlib
 import io
+import multiprocessing
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
 
 import pybase64
+from fastapi import HTTPException
 from PIL import Image
+from starlette.concurrency import run_in_threadpool
 
-from utils.Client import Client
-from utils.configs import export_proxy_url, cf_file_url
+from api.tokens import scaled_image_size
+from utils.Client import client_pool, abort_response
+from utils.Logger import logger
+from utils.configs import export_proxy_url, cf_file_url, upload_max_size, upload_spool_size, image_resize, \
+    image_resize_workers, image_resize_quality, image_resize_min_bytes
+
+HEAD_SIZE = 64 * 1024
+
+MAGIC_NUMBERS = [
+    (b"\x89PNG\r\n\x1a\n", "image/png"),
+    (b"\xff\xd8\xff", "image/jpeg"),
+    (b"GIF87a", "image/gif"),
+    (b"GIF89a", "image/gif"),
+    (b"%PDF-", "application/pdf"),
+]
+
+
+class FileContent:
+    """Attachment bytes spooled to a temp file, in memory up to `spool_size` and on disk beyond.
+
+    The first HEAD_SIZE bytes are kept aside for type and dimension sniffing
+    and the sha256 is computed while writing, so neither needs another pass.
+    """
+
+    def __init__(self, spool_size=upload_spool_size):
+        self.file = tempfile.SpooledTemporaryFile(max_size=spool_size)
+        self.size = 0
+        self.head = b""
+        self._sha256 = hashlib.sha256()
+
+    def __len__(self):
+        return self.size
+
+    def write(self, chunk):
+        if len(self.head) < HEAD_SIZE:
+            self.head += chunk[:HEAD_SIZE - len(self.head)]
+        self.file.write(chunk)
+        self._sha256.update(chunk)
+        self.size += len(chunk)
+
+    @property
+    def sha256(self):
+        return self._sha256.hexdigest()
+
+    def read(self, offset=0, size=-1):
+        self.file.seek(offset)
+        return self.file.read(size)
+
+    def replace(self, data):
+        self.file.seek(0)
+        self.file.truncate()
+        self.size = 0
+        self.head = b""
+        self._sha256 = hashlib.sha256()
+        self.write(data)
+
+    def close(self):
+        self.file.close()
+
+
+def check_file_size(size):
+    if 0 < upload_max_size < size:
+        raise HTTPException(status_code=413, detail=f"File too large, the limit is {upload_max_size} bytes")
+
+
+def sniff_mime_type(head, mime_type):
+    """Trust the magic number for images, fall back to it for a missing or generic type."""
+    sniffed = next((sniffed for magic, sniffed in MAGIC_NUMBERS if head.startswith(magic)), None)
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        sniffed = "image/webp"
+    if sniffed and (sniffed.startswith("image/") or mime_type in ("", "application/octet-stream")):
+        return sniffed
+    return mime_type
 
 
 async def get_file_content(url):
     if url.startswith("data:"):
-        mime_type, base64_data = url.split(';')[0].split(':')[1], url.split(',')[1]
-        file_content = pybase64.b64decode(base64_data)
-        return file_content, mime_type
-    else:
-        client = Client()
+        header, _, base64_data = url.partition(',')
+        mime_type = header.split(';')[0].split(':')[1]
+        check_file_size(len(base64_data) * 3 // 4)
+        file_content = FileContent()
+        file_content.write(pybase64.b64decode(base64_data))
+        return file_content, sniff_mime_type(file_content.head, mime_type)
+
+    client = await client_pool.acquire()
+    file_content = FileContent()
+    try:
+        if cf_file_url:
+            body = {"file_url": url}
+            r = await client.post(cf_file_url, timeout=60, json=body, stream=True)
+        else:
+            r = await client.get(url, proxy=export_proxy_url, timeout=60, stream=True)
         try:
-            if cf_file_url:
-                body = {"file_url": url}
-                r = await client.post(cf_file_url, timeout=60, json=body)
-            else:
-                r = await client.get(url, proxy=export_proxy_url, timeout=60)
             if r.status_code != 200:
+                abort_response(r)
+                file_content.close()
                 return None, None
-            file_content = r.content
-            mime_type = r.headers.get('Content-Type', '').split(';')[0].strip()
-            return file_content, mime_type
+            content_length = r.headers.get('Content-Length', '')
+            if content_length.isdigit():
+                check_file_size(int(content_length))
+            async for chunk in r.aiter_content():
+                file_content.write(chunk)
+                check_file_size(file_content.size)
+        except BaseException:
+            # aclose would otherwise download the rest of a rejected body
+            abort_response(r)
+            raise
         finally:
-            await client.close()
-            del client
+            await r.aclose()
+        mime_type = r.headers.get('Content-Type', '').split(';')[0].strip()
+        return file_content, sniff_mime_type(file_content.head, mime_type)
+    except BaseException:
+        file_content.close()
+        raise
+    finally:
+        await client_pool.release(client)
 
 
 async def determine_file_use_case(mime_type):
@@ -48,11 +146,146 @@ async def determine_file_use_case(mime_type):
         return "ace_upload"
 
 
-async def get_image_size(file_content):
-    with Image.open(io.BytesIO(file_content)) as img:
+JPEG_SOF_MARKERS = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+
+
+def parse_image_size(data):
+    """Read (width, height) from a PNG, JPEG, GIF or WebP header without decoding, or None."""
+    if data.startswith(b"\x89PNG\r\n\x1a\n") and data[12:16] == b"IHDR":
+        return int.from_bytes(data[16:20], "big"), int.from_bytes(data[20:24], "big")
+    if data[:6] in (b"GIF87a", b"GIF89a") and len(data) >= 10:
+        return int.from_bytes(data[6:8], "little"), int.from_bytes(data[8:10], "little")
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        chunk = data[12:16]
+        if chunk == b"VP8 " and data[23:26] == b"\x9d\x01\x2a":
+            return int.from_bytes(data[26:28], "little") & 0x3FFF, int.from_bytes(data[28:30], "little") & 0x3FFF
+        if chunk == b"VP8L" and data[20:21] == b"\x2f":
+            bits = int.from_bytes(data[21:25], "little")
+            return (bits & 0x3FFF) + 1, ((bits >> 14) & 0x3FFF) + 1
+        if chunk == b"VP8X" and len(data) >= 30:
+            return int.from_bytes(data[24:27], "little") + 1, int.from_bytes(data[27:30], "little") + 1
+        return None
+    if data[:2] == b"\xff\xd8":
+        # Walk the marker segments up to the first start-of-frame
+        i = 2
+        while i + 9 <= len(data):
+            if data[i] != 0xFF:
+                return None
+            marker = data[i + 1]
+            if marker == 0xFF:
+                i += 1
+            elif marker in JPEG_SOF_MARKERS:
+                return int.from_bytes(data[i + 7:i + 9], "big"), int.from_bytes(data[i + 5:i + 7], "big")
+            elif marker == 0x01 or 0xD0 <= marker <= 0xD8:
+                i += 2
+            else:
+                i += 2 + int.from_bytes(data[i + 2:i + 4], "big")
+    return None
+
+
+def read_image_size(file_content):
+    file_content.file.seek(0)
+    with Image.open(file_content.file) as img:
         return img.width, img.height
 
 
+async def get_image_size(file_content):
+    size = parse_image_size(file_content.head)
+    if size:
+        return size
+    # Unknown format, or a header that did not fit in the first bytes
+    return await run_in_threadpool(read_image_size, file_content)
+
+
+RESIZE_FORMATS = {"image/jpeg": "JPEG", "image/png": "PNG", "image/webp": "WEBP"}
+
+
+def resize_image(data, mime_type, size, quality):
+    """Downscale and re-encode in the original format; runs in a worker process."""
+    with Image.open(io.BytesIO(data)) as img:
+        options = {key: img.info[key] for key in ("exif", "icc_profile") if img.info.get(key)}
+        if mime_type == "image/png":
+            options["optimize"] = True
+        else:
+            options["quality"] = quality
+        if mime_type == "image/jpeg" and img.mode not in ("RGB", "L", "CMYK"):
+            img = img.convert("RGB")
+        resized = img.resize(size, Image.LANCZOS)
+        buffer = io.BytesIO()
+        resized.save(buffer, RESIZE_FORMATS[mime_type], **options)
+        return buffer.getvalue()
+
+
+class ImageResizer:
+    """Shrinks oversized images to the resolution the model sees them at before upload.
+
+    The server downscales to the `scaled_image_size` box for the requested
+    `detail` anyway, so sending that box instead of a 12 MP original saves
+    upload bytes and time without changing what the model gets. Resizing
+    runs in a process pool; images under `min_bytes`, animated GIFs and
+    results that are not smaller than the original are sent as-is.
+    """
+
+    def __init__(self, enabled=False, workers=2, quality=85, min_bytes=256 * 1024):
+        self.enabled = enabled
+        self.workers = workers
+        self.quality = quality
+        self.min_bytes = min_bytes
+        self._executor = None
+        self.metrics = {"resized": 0, "skipped": 0, "failed": 0, "bytes_in": 0, "bytes_out": 0}
+
+    @staticmethod
+    def variant(detail):
+        return "low" if detail == "low" else "high"
+
+    async def resize(self, file_content, mime_type, width, height, detail):
+        """Resize `file_content` in place; returns the (width, height) it ends up with."""
+        if not self.enabled or mime_type not in RESIZE_FORMATS or file_content.size < self.min_bytes:
+            return width, height
+        size = scaled_image_size(width, height, detail)
+        if size == (width, height) or min(size) < 1:
+            self.metrics["skipped"] += 1
+            return width, height
+
+        if self._executor is None:
+            # Never fork the threaded server process
+            self._executor = ProcessPoolExecutor(max_workers=max(self.workers, 1),
+                                                 mp_context=multiprocessing.get_context("spawn"))
+        try:
+            data = await run_in_threadpool(file_content.read)
+            resized = await asyncio.get_running_loop().run_in_executor(
+                self._executor, resize_image, data, mime_type, size, self.quality)
+        except Exception as e:
+            logger.warning(f"Failed to resize image, uploading the original: {e}")
+            self.metrics["failed"] += 1
+            return width, height
+        if len(resized) >= len(data):
+            self.metrics["skipped"] += 1
+            return width, height
+
+        await run_in_threadpool(file_content.replace, resized)
+        self.metrics["resized"] += 1
+        self.metrics["bytes_in"] += len(data)
+        self.metrics["bytes_out"] += len(resized)
+        logger.info(f"Resized image {width}x{height} to {size[0]}x{size[1]}, {len(data)} -> {len(resized)} bytes")
+        return size
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    def stats(self):
+        return {
+            "enabled": self.enabled,
+            "bytes_saved": self.metrics["bytes_in"] - self.metrics["bytes_out"],
+            **self.metrics,
+        }
+
+
+image_resizer = ImageResizer(image_resize, image_resize_workers, image_resize_quality, image_resize_min_bytes)
+
+
 async def get_file_extension(mime_type):
     extension_mapping = {
         "image/jpeg": ".jpg",
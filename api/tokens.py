@@ -1,32 +1,191 @@
+import asyncio
+import functools
+import hashlib
 import math
+import os
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
+import regex
 import tiktoken
+from tiktoken.model import encoding_name_for_model
+
+from api.models import model_proxy
+from utils.configs import (
+    tiktoken_cache_dir,
+    token_cache_size,
+    tokenizer_offload_threshold,
+    tokenizer_workers,
+)
+from utils.Logger import logger
+
+
+class TokenizerRegistry:
+    """Loads tiktoken encodings once and maps model names to them.
+
+    Encodings are read from `cache_dir` (the Docker image ships it prebuilt),
+    so a live request never downloads or builds BPE ranks. The known models
+    are resolved up front; unknown ones fall back to cl100k_base.
+    """
+
+    encoding_names = ("cl100k_base", "o200k_base")
+    default_encoding = "cl100k_base"
+    max_models = 1024
+
+    def __init__(self, cache_dir=None, models=()):
+        self.cache_dir = cache_dir
+        self.models = models
+        self.encodings = {}
+        self.model_table = {}
+
+    def load(self):
+        if self.cache_dir:
+            os.environ["TIKTOKEN_CACHE_DIR"] = os.path.abspath(self.cache_dir)
+        start = time.perf_counter()
+        for name in self.encoding_names:
+            try:
+                self.encodings[name] = tiktoken.get_encoding(name)
+            except Exception as e:
+                logger.warning(f"Tokenizer: failed to load {name}: {e}")
+        for model in self.models:
+            name = self.encoding_name(model)
+            if name in self.encodings:
+                self.model_table[model] = self.encodings[name]
+        logger.info(f"Tokenizer: loaded {', '.join(self.encodings) or 'no encodings'} for {len(self.model_table)} "
+                    f"models in {time.perf_counter() - start:.2f}s from {os.environ.get('TIKTOKEN_CACHE_DIR')}")
+
+    def encoding_name(self, model):
+        try:
+            return encoding_name_for_model(model)
+        except KeyError:
+            return self.default_encoding
+
+    def get(self, model=None):
+        encoding = self.model_table.get(model)
+        if encoding is None:
+            name = self.encoding_name(model) if model else self.default_encoding
+            encoding = self.encodings.get(name)
+            if encoding is None:
+                encoding = self.encodings[name] = tiktoken.get_encoding(name)
+            if len(self.model_table) < self.max_models:
+                self.model_table[model] = encoding
+        return encoding
+
+
+tokenizer_registry = TokenizerRegistry(tiktoken_cache_dir, [*model_proxy, *model_proxy.values()])
+
+
+def get_encoding(model=None):
+    return tokenizer_registry.get(model)
+
+
+class TokenCountCache:
+    """Bounded LRU of per-message token counts.
+
+    Multi-turn clients resend the whole history on every call; keying each
+    message by a digest of (encoding, fields) means only new or edited turns
+    are tokenized. Digests keep the entries small regardless of message size.
+    """
+
+    def __init__(self, max_size=4096):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(encoding, message):
+        digest = hashlib.blake2b(encoding.name.encode(), digest_size=16)
+        for key, value in message.items():
+            if isinstance(value, list):
+                value = "\0".join(item.get("text") for item in value if item.get("type") == "text")
+            digest.update(b"\1" + str(key).encode() + b"\2" + value.encode("utf-8", "surrogatepass"))
+        return digest.digest()
+
+    def get(self, key):
+        num_tokens = self._entries.get(key)
+        if num_tokens is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._entries.move_to_end(key)
+        return num_tokens
+
+    def put(self, key, num_tokens):
+        if self.max_size <= 0:
+            return
+        self._entries[key] = num_tokens
+        if len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+        }
+
+
+token_count_cache = TokenCountCache(token_cache_size)
+
+
+class TokenizerPool:
+    """Runs large tokenization jobs off the event loop.
+
+    tiktoken releases the GIL while encoding, so a small thread pool keeps a
+    100k-token prompt from stalling every other stream on the worker. Jobs
+    below `threshold` characters stay inline, where a thread hop would cost
+    more than the encoding itself.
+    """
+
+    def __init__(self, workers=2, threshold=32768):
+        self.workers = workers
+        self.threshold = threshold
+        self._executor = None
+
+    async def run(self, size, func, *args):
+        if self.workers <= 0 or size < self.threshold:
+            return func(*args)
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="tokenizer")
+        return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+
+tokenizer_pool = TokenizerPool(tokenizer_workers, tokenizer_offload_threshold)
+
+
+def scaled_image_size(width, height, detail):
+    """The resolution the model sees an image at for a `detail` level."""
+    if detail == "low":
+        scale_factor = min(512 / max(width, height), 1)
+        return int(width * scale_factor), int(height * scale_factor)
+
+    max_dimension = max(width, height)
+    if max_dimension > 2048:
+        scale_factor = 2048 / max_dimension
+        width, height = int(width * scale_factor), int(height * scale_factor)
+
+    min_dimension = min(width, height)
+    if min_dimension > 768:
+        scale_factor = 768 / min_dimension
+        width, height = int(width * scale_factor), int(height * scale_factor)
+    return width, height
 
 
 async def calculate_image_tokens(width, height, detail):
     if detail == "low":
         return 85
     else:
-        max_dimension = max(width, height)
-        if max_dimension > 2048:
-            scale_factor = 2048 / max_dimension
-            new_width = int(width * scale_factor)
-            new_height = int(height * scale_factor)
-        else:
-            new_width = width
-            new_height = height
-
-        width, height = new_width, new_height
-        min_dimension = min(width, height)
-        if min_dimension > 768:
-            scale_factor = 768 / min_dimension
-            new_width = int(width * scale_factor)
-            new_height = int(height * scale_factor)
-        else:
-            new_width = width
-            new_height = height
-
-        width, height = new_width, new_height
+        width, height = scaled_image_size(width, height, detail)
         num_masks_w = math.ceil(width / 512)
         num_masks_h = math.ceil(height / 512)
         total_masks = num_masks_w * num_masks_h
@@ -38,49 +197,176 @@ async def calculate_image_tokens(width, height, detail):
 
 
 async def num_tokens_from_messages(messages, model=''):
-    try:
-        encoding = tiktoken.encoding_for_model(model)
-    except KeyError:
-        encoding = tiktoken.get_encoding("cl100k_base")
+    encoding = get_encoding(model)
     if model == "gpt-3.5-turbo-0301":
         tokens_per_message = 4
     else:
         tokens_per_message = 3
     num_tokens = 0
+    missed_keys = []
+    missed_messages = []
     for message in messages:
         num_tokens += tokens_per_message
-        for key, value in message.items():
-            if isinstance(value, list):
-                for item in value:
-                    if item.get("type") == "text":
-                        num_tokens += len(encoding.encode(item.get("text")))
-                    if item.get("type") == "image_url":
-                        pass
-            else:
-                num_tokens += len(encoding.encode(value))
+        key = token_count_cache.key(encoding, message)
+        cached = token_count_cache.get(key)
+        if cached is None:
+            missed_keys.append(key)
+            missed_messages.append(message)
+        else:
+            num_tokens += cached
+    if missed_messages:
+        size = sum(message_length(message) for message in missed_messages)
+        counts = await tokenizer_pool.run(size, count_messages_tokens, encoding, missed_messages)
+        for key, count in zip(missed_keys, counts):
+            token_count_cache.put(key, count)
+            num_tokens += count
     num_tokens += 3
     return num_tokens
 
 
+def message_length(message):
+    length = 0
+    for value in message.values():
+        if isinstance(value, list):
+            length += sum(len(item.get("text")) for item in value if item.get("type") == "text")
+        elif isinstance(value, str):
+            length += len(value)
+    return length
+
+
+def count_messages_tokens(encoding, messages):
+    return [count_message_tokens(encoding, message) for message in messages]
+
+
+def count_message_tokens(encoding, message):
+    num_tokens = 0
+    for key, value in message.items():
+        if isinstance(value, list):
+            for item in value:
+                if item.get("type") == "text":
+                    num_tokens += len(encoding.encode(item.get("text")))
+                if item.get("type") == "image_url":
+                    pass
+        else:
+            num_tokens += len(encoding.encode(value))
+    return num_tokens
+
+
 async def num_tokens_from_content(content, model=None):
-    try:
-        encoding = tiktoken.encoding_for_model(model)
-    except KeyError:
-        encoding = tiktoken.get_encoding("cl100k_base")
-    encoded_content = encoding.encode(content)
+    encoding = get_encoding(model)
+    encoded_content = await tokenizer_pool.run(len(content), encoding.encode, content)
     len_encoded_content = len(encoded_content)
     return len_encoded_content
 
 
 async def split_tokens_from_content(content, max_tokens, model=None):
-    try:
-        encoding = tiktoken.encoding_for_model(model)
-    except KeyError:
-        encoding = tiktoken.get_encoding("cl100k_base")
-    encoded_content = encoding.encode(content)
+    encoding = get_encoding(model)
+    encoded_content = await tokenizer_pool.run(len(content), encoding.encode, content)
     len_encoded_content = len(encoded_content)
     if len_encoded_content >= max_tokens:
         content = encoding.decode(encoded_content[:max_tokens])
         return content, max_tokens, "length"
     else:
         return content, len_encoded_content, "stop"
+
+
+# Pre-tokenizer patterns of the encodings tiktoken ships (see tiktoken_ext.openai_public),
+# which keeps them as constructor locals rather than public attributes
+PRE_TOKENIZER_PATTERNS = {
+    "cl100k_base": r"""'(?i:[sdmt]|ll|ve|re)|[^\r\n\p{L}\p{N}]?+\p{L}++|\p{N}{1,3}+| ?[^\s\p{L}\p{N}]++[\r\n]*+"""
+                   r"""|\s++$|\s*[\r\n]|\s+(?!\S)|\s""",
+    "o200k_base": "|".join([
+        r"""[^\r\n\p{L}\p{N}]?[\p{Lu}\p{Lt}\p{Lm}\p{Lo}\p{M}]*[\p{Ll}\p{Lm}\p{Lo}\p{M}]+"""
+        r"""(?i:'s|'t|'re|'ve|'m|'ll|'d)?""",
+        r"""[^\r\n\p{L}\p{N}]?[\p{Lu}\p{Lt}\p{Lm}\p{Lo}\p{M}]+[\p{Ll}\p{Lm}\p{Lo}\p{M}]*"""
+        r"""(?i:'s|'t|'re|'ve|'m|'ll|'d)?""",
+        r"""\p{N}{1,3}""",
+        r""" ?[^\s\p{L}\p{N}]+[\r\n/]*""",
+        r"""\s*[\r\n]+""",
+        r"""\s+(?!\S)""",
+        r"""\s+""",
+    ]),
+}
+PRE_TOKENIZER_PATTERNS["o200k_harmony"] = PRE_TOKENIZER_PATTERNS["o200k_base"]
+whitespace_piece = regex.compile(r"\s+")
+
+
+@functools.lru_cache(maxsize=None)
+def pre_tokenizer(encoding_name):
+    pat_str = PRE_TOKENIZER_PATTERNS.get(encoding_name)
+    return regex.compile(pat_str) if pat_str else None
+
+
+class StreamTokenCounter:
+    """Counts completion tokens incrementally as deltas arrive.
+
+    BPE never merges across the pieces the encoding's pre-tokenizer regex
+    splits text into, so finished pieces can be counted once and forgotten
+    and only a short tail is re-encoded on each delta. A cut is only made
+    before the second-to-last piece and after a piece that is not pure
+    whitespace: on its own, a prefix ending in whitespace gets its trailing run
+    split as end-of-text whitespace, not the way it is split in context. With
+    those cuts the count equals `len(encode(whole_text))`. `add` truncates the delta so the total never
+    exceeds `max_tokens`.
+
+    The exception is a tail that grows past `max_pending` characters without
+    such a cut (e.g. a CJK run with no punctuation, or an encoding whose
+    pattern is not in PRE_TOKENIZER_PATTERNS): it is cut in half and may be
+    off by a few tokens rather than re-encoded forever.
+    """
+
+    max_pending = 512
+
+    def __init__(self, model=None, max_tokens=2147483647):
+        self.encoding = get_encoding(model)
+        self.pattern = pre_tokenizer(self.encoding.name)
+        self.max_tokens = max_tokens
+        self.committed = 0
+        self.pending = ""
+        self.pending_tokens = []
+        self.exhausted = False
+
+    @property
+    def count(self):
+        return self.committed + len(self.pending_tokens)
+
+    def encode(self, text):
+        return self.encoding.encode(text, disallowed_special=())
+
+    def add(self, text):
+        if self.exhausted or not text:
+            return ""
+        previous = self.pending
+        self.pending += text
+        self.pending_tokens = self.encode(self.pending)
+        if self.count >= self.max_tokens:
+            self.exhausted = True
+            if self.count > self.max_tokens:
+                keep = self.pending_tokens[:len(self.pending_tokens) - (self.count - self.max_tokens)]
+                allowed = self.encoding.decode_bytes(keep).decode("utf-8", errors="ignore")
+                self.pending_tokens = keep
+                self.pending = allowed
+                return allowed[len(previous):]
+            return text
+        self.commit()
+        return text
+
+    def commit(self):
+        split = self.find_boundary(self.pending)
+        if split is None and len(self.pending) > self.max_pending:
+            # No exact cut this far back; accept a tiny miscount over unbounded re-encoding
+            split = len(self.pending) // 2
+        if split:
+            self.committed += len(self.encode(self.pending[:split]))
+            self.pending = self.pending[split:]
+            self.pending_tokens = self.encode(self.pending)
+
+    def find_boundary(self, text):
+        """Latest piece start before the last piece that follows a non-whitespace piece, or None."""
+        if self.pattern is None:
+            return None
+        starts = [match.start() for match in self.pattern.finditer(text)]
+        for i in range(len(starts) - 2, 0, -1):
+            if not whitespace_piece.fullmatch(text, starts[i - 1], starts[i]):
+                return starts[i]
+        return None
@@ -2,23 +2,30 @@ import asyncio
 import hashlib
 import json
 import random
+import time
 import uuid
+from urllib.parse import quote
 
+import pybase64
 from fastapi import HTTPException
 from starlette.concurrency import run_in_threadpool
 
-from api.files import get_image_size, get_file_extension, determine_file_use_case
+from api.files import get_image_size, get_file_extension, determine_file_use_case, image_resizer
 from api.models import model_proxy
+from api.tokens import StreamTokenCounter, num_tokens_from_messages
 from chatgpt.authorization import get_req_token, verify_token
-from chatgpt.chatFormat import api_messages_to_chat, stream_response, format_not_stream_response, head_process_response
+from chatgpt.chatFormat import api_messages_to_chat, stream_response, format_not_stream_response, head_process_response, \
+    parse_upstream_events, response_deltas
 from chatgpt.chatLimit import check_is_limit, handle_request_limit
+from chatgpt.conversationSessions import conversation_sessions
 from chatgpt.fp import get_fp
+from chatgpt.hostSelector import host_selector
 from chatgpt.proofofWork import get_config, get_dpl, get_answer_token, get_requirements_token
+from chatgpt.uploadCache import upload_cache
 
-from utils.Client import Client
+from utils.Client import client_pool, abort_response, iter_stream
 from utils.Logger import logger
 from utils.configs import (
-    chatgpt_base_url_list,
     ark0se_token_url_list,
     sentinel_proxy_url_list,
     history_disabled,
@@ -29,6 +36,8 @@ from utils.configs import (
     auth_key,
     turnstile_solver_url,
     oai_language,
+    delta_encoding,
+    upload_block_size,
 )
 
 
@@ -40,6 +49,7 @@ class ChatService:
         self.s = None
         self.ss = None
         self.ws = None
+        self.upstream = None
 
     async def set_dynamic_data(self, data):
         if self.req_token:
@@ -84,15 +94,15 @@ class ChatService:
 
         # self.proxy_url = random.choice(proxy_url_list) if proxy_url_list else None
 
-        self.host_url = random.choice(chatgpt_base_url_list) if chatgpt_base_url_list else "https://chatgpt.com"
+        self.host_url = host_selector.select()
         self.ark0se_token_url = random.choice(ark0se_token_url_list) if ark0se_token_url_list else None
 
         session_id = hashlib.md5(self.req_token.encode()).hexdigest()
         proxy_url = self.proxy_url.replace("{}", session_id) if self.proxy_url else None
-        self.s = Client(proxy=proxy_url, impersonate=self.impersonate)
+        self.s = await client_pool.acquire(proxy=proxy_url, impersonate=self.impersonate)
         if sentinel_proxy_url_list:
             sentinel_proxy_url = (random.choice(sentinel_proxy_url_list)).replace("{}", session_id) if sentinel_proxy_url_list else None
-            self.ss = Client(proxy=sentinel_proxy_url, impersonate=self.impersonate)
+            self.ss = await client_pool.acquire(proxy=sentinel_proxy_url, impersonate=self.impersonate)
         else:
             self.ss = self.s
 
@@ -186,7 +196,7 @@ class ChatService:
             config = get_config(self.user_agent, self.req_token)
             p = get_requirements_token(config)
             data = {'p': p}
-            r = await self.ss.post(url, headers=headers, json=data, timeout=5)
+            r = await self.timed_request(self.ss.post, url, headers=headers, json=data, timeout=5)
             if r.status_code == 200:
                 resp = r.json()
 
@@ -228,11 +238,11 @@ class ChatService:
                     if not self.ark0se_token_url:
                         raise HTTPException(status_code=403, detail="Ark0se service required")
                     ark0se_dx = ark0se.get("dx")
-                    ark0se_client = Client(impersonate=self.impersonate)
                     try:
-                        r2 = await ark0se_client.post(
-                            url=self.ark0se_token_url, json={"blob": ark0se_dx, "method": ark0se_method}, timeout=15
-                        )
+                        async with client_pool.borrow(impersonate=self.impersonate) as ark0se_client:
+                            r2 = await ark0se_client.post(
+                                url=self.ark0se_token_url, json={"blob": ark0se_dx, "method": ark0se_method}, timeout=15
+                            )
                         r2esp = r2.json()
                         logger.info(f"ark0se_token: {r2esp}")
                         if r2esp.get('solved', True):
@@ -241,8 +251,6 @@ class ChatService:
                             raise HTTPException(status_code=403, detail="Failed to get Ark0se token")
                     except Exception:
                         raise HTTPException(status_code=403, detail="Failed to get Ark0se token")
-                    finally:
-                        await ark0se_client.close()
 
                 proofofwork = resp.get('proofofwork', {})
                 proofofwork_required = proofofwork.get('required')
@@ -277,8 +285,22 @@ class ChatService:
             raise HTTPException(status_code=500, detail=str(e))
 
     async def prepare_send_conversation(self):
+        api_messages = self.api_messages
+        history_tokens = 0
+        session = None
+        if conversation_sessions.enabled and not self.history_disabled and not self.conversation_id:
+            session = conversation_sessions.lookup(self.req_token, api_messages)
+        if session:
+            # Continue the upstream conversation and only send the turns it has not seen
+            self.conversation_id, self.parent_message_id, history, api_messages = session
+            history_tokens = await num_tokens_from_messages(history, self.resp_model) - 3
+            logger.info(f"Continuing conversation {self.conversation_id}, sending {len(api_messages)} of "
+                        f"{len(self.api_messages)} messages")
         try:
-            chat_messages, self.prompt_tokens = await api_messages_to_chat(self, self.api_messages, upload_by_url)
+            chat_messages, self.prompt_tokens = await api_messages_to_chat(self, api_messages, upload_by_url)
+            self.prompt_tokens += history_tokens
+        except HTTPException:
+            raise
         except Exception as e:
             logger.error(f"Failed to format messages: {str(e)}")
             raise HTTPException(status_code=400, detail="Failed to format messages.")
@@ -334,7 +356,7 @@ class ChatService:
             "parent_message_id": self.parent_message_id if self.parent_message_id else f"{uuid.uuid4()}",
             "reset_rate_limits": False,
             "suggestions": [],
-            "supported_encodings": [],
+            "supported_encodings": ["v1"] if delta_encoding else [],
             "system_hints": [],
             "timezone": "America/Los_Angeles",
             "timezone_offset_min": -480,
@@ -349,7 +371,9 @@ class ChatService:
         try:
             url = f'{self.base_url}/conversation'
             stream = self.data.get("stream", False)
-            r = await self.s.post_stream(url, headers=self.chat_headers, json=self.chat_request, timeout=10, stream=True)
+            r = await self.timed_request(
+                self.s.post_stream, url, headers=self.chat_headers, json=self.chat_request, timeout=10, stream=True
+            )
             if r.status_code != 200:
                 rtext = await r.atext()
                 if "application/json" == r.headers.get("Content-Type", ""):
@@ -369,7 +393,8 @@ class ChatService:
 
             content_type = r.headers.get("Content-Type", "")
             if "text/event-stream" in content_type:
-                res, start = await head_process_response(r.aiter_lines())
+                self.upstream = r
+                res, start = await head_process_response(parse_upstream_events(iter_stream(r)))
                 if not start:
                     raise HTTPException(
                         status_code=403,
@@ -378,10 +403,11 @@ class ChatService:
                 if stream:
                     return stream_response(self, res, self.resp_model, self.max_tokens)
                 else:
+                    counter = StreamTokenCounter(self.resp_model, self.max_tokens)
                     return await format_not_stream_response(
-                        stream_response(self, res, self.resp_model, self.max_tokens),
+                        response_deltas(self, res, counter),
                         self.prompt_tokens,
-                        self.max_tokens,
+                        counter,
                         self.resp_model,
                     )
             elif "application/json" in content_type:
@@ -396,6 +422,16 @@ class ChatService:
         except Exception as e:
             raise HTTPException(status_code=500, detail=str(e))
 
+    async def timed_request(self, func, *args, **kwargs):
+        start = time.monotonic()
+        try:
+            r = await func(*args, **kwargs)
+        except Exception:
+            host_selector.record(self.host_url, error=True)
+            raise
+        host_selector.record(self.host_url, ttfb=(time.monotonic() - start) * 1000, error=r.status_code >= 500)
+        return r
+
     async def get_download_url(self, file_id):
         url = f"{self.base_url}/files/{file_id}/download"
         headers = self.base_headers.copy()
@@ -474,7 +510,10 @@ class ChatService:
         headers.pop('oai-device-id', None)
         headers.pop('oai-language', None)
         try:
-            r = await self.s.put(upload_url, headers=headers, data=file_content, timeout=60)
+            if file_content.size > upload_block_size > 0:
+                return await self.upload_blocks(upload_url, file_content, headers)
+            data = await run_in_threadpool(file_content.read)
+            r = await self.s.put(upload_url, headers=headers, data=data, timeout=60)
             if r.status_code == 201:
                 return True
             else:
@@ -483,10 +522,43 @@ class ChatService:
             logger.error(f"Failed to upload file: {e}")
             return False
 
-    async def upload_file(self, file_content, mime_type):
+    async def upload_blocks(self, upload_url, file_content, headers):
+        """Put Block per chunk then Put Block List, so only one block is in memory at a time."""
+        separator = '&' if '?' in upload_url else '?'
+        block_headers = {key: value for key, value in headers.items() if key not in ('content-type', 'x-ms-blob-type')}
+        block_ids = []
+        for offset in range(0, file_content.size, upload_block_size):
+            block_id = pybase64.b64encode(f"{len(block_ids):08d}".encode()).decode()
+            block = await run_in_threadpool(file_content.read, offset, upload_block_size)
+            r = await self.s.put(f"{upload_url}{separator}comp=block&blockid={quote(block_id)}",
+                                 headers=block_headers, data=block, timeout=60)
+            if r.status_code != 201:
+                raise HTTPException(status_code=r.status_code, detail=r.text)
+            block_ids.append(block_id)
+
+        block_list = "".join(f"<Latest>{block_id}</Latest>" for block_id in block_ids)
+        body = f'<?xml version="1.0" encoding="utf-8"?><BlockList>{block_list}</BlockList>'
+        list_headers = {**block_headers, 'x-ms-blob-content-type': headers['content-type']}
+        r = await self.s.put(f"{upload_url}{separator}comp=blocklist", headers=list_headers, data=body, timeout=60)
+        if r.status_code != 201:
+            raise HTTPException(status_code=r.status_code, detail=r.text)
+        logger.info(f"Uploaded {file_content.size} bytes in {len(block_ids)} blocks")
+        return True
+
+    async def upload_file(self, file_content, mime_type, detail=None):
         if not file_content or not mime_type:
             return None
 
+        cache_key = None
+        if upload_cache.enabled:
+            sha256 = file_content.sha256
+            if image_resizer.enabled and mime_type.startswith("image/"):
+                # The same image is uploaded at a different resolution per detail level
+                sha256 = f"{sha256}:{image_resizer.variant(detail)}"
+            cache_key, file_meta = await upload_cache.get(self.req_token, self.account_id, sha256)
+            if file_meta:
+                return file_meta
+
         width, height = None, None
         if mime_type.startswith("image/"):
             try:
@@ -494,7 +566,9 @@ class ChatService:
             except Exception as e:
                 logger.error(f"Error image mime_type, change to text/plain: {e}")
                 mime_type = 'text/plain'
-        file_size = len(file_content)
+            else:
+                width, height = await image_resizer.resize(file_content, mime_type, width, height, detail)
+        file_size = file_content.size
         file_extension = await get_file_extension(mime_type)
         file_name = f"{uuid.uuid4()}{file_extension}"
         use_case = await determine_file_use_case(mime_type)
@@ -514,6 +588,8 @@ class ChatService:
                         "use_case": use_case,
                     }
                     logger.info(f"File_meta: {file_meta}")
+                    if cache_key:
+                        await upload_cache.set(cache_key, file_meta)
                     return file_meta
 
     async def check_upload(self, file_id):
@@ -546,13 +622,22 @@ class ChatService:
             logger.info("Failed to get response file url")
             return None
 
+    def remember_conversation(self, reply, message_id, conversation_id):
+        if conversation_sessions.enabled and not self.history_disabled:
+            conversation_sessions.record(self.req_token, self.api_messages, reply, conversation_id, message_id)
+
+    def abort(self):
+        if self.upstream is not None:
+            abort_response(self.upstream)
+
     async def close_client(self):
+        self.abort()
+        if self.ss and self.ss is not self.s:
+            await client_pool.release(self.ss)
+        self.ss = None
         if self.s:
-            await self.s.close()
-            del self.s
-        if self.ss:
-            await self.ss.close()
-            del self.ss
+            await client_pool.release(self.s)
+            self.s = None
         if self.ws:
             await self.ws.close()
             del self.ws
@@ -0,0 +1,49 @@
+import asyncio
+import time
+from collections import OrderedDict
+
+from utils.configs import attachment_url_ttl
+
+
+class AttachmentUrlCache:
+    """TTL cache of resolved download URLs keyed by (conversation_id, file_id).
+
+    `resolve` starts the lookup right away and returns an awaitable, so the
+    stream can keep flowing until the URL has to be emitted. Lookups still in
+    flight are shared, and resolved URLs are reused on retries and
+    regenerations until they expire. Empty results are never cached.
+    """
+
+    def __init__(self, ttl=300, max_size=1024):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._pending = {}
+
+    def resolve(self, key, func, *args):
+        entry = self._entries.get(key)
+        if entry is not None:
+            expires_at, url = entry
+            if expires_at > time.monotonic():
+                future = asyncio.get_running_loop().create_future()
+                future.set_result(url)
+                return future
+            del self._entries[key]
+        task = self._pending.get(key)
+        if task is None:
+            task = self._pending[key] = asyncio.ensure_future(self._fetch(key, func, *args))
+        return task
+
+    async def _fetch(self, key, func, *args):
+        try:
+            url = await func(*args)
+        finally:
+            self._pending.pop(key, None)
+        if url and self.ttl > 0:
+            self._entries[key] = (time.monotonic() + self.ttl, url)
+            if len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+        return url
+
+
+attachment_url_cache = AttachmentUrlCache(attachment_url_ttl)
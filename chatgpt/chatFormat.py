@@ -12,36 +12,36 @@ from fastapi import HTTPException
 
 from api.files import get_file_content
 from api.models import model_system_fingerprint
-from api.tokens import split_tokens_from_content, calculate_image_tokens, num_tokens_from_messages
+from api.tokens import calculate_image_tokens, num_tokens_from_messages, StreamTokenCounter
+from chatgpt.attachmentCache import attachment_url_cache
+from chatgpt.chunkEncoder import ChunkEncoder
+from chatgpt.deltaEncoding import DeltaDecoder
+from utils import json_utils
 from utils.Logger import logger
+from utils.configs import upload_concurrency
+from utils.sse import iter_sse_events
 
 moderation_message = "I'm sorry, I cannot provide or engage in any content related to pornography, violence, or any unethical material. If you have any other questions or need assistance, please feel free to let me know. I'll do my best to provide support and assistance."
 
 
-async def format_not_stream_response(response, prompt_tokens, max_tokens, model):
+async def format_not_stream_response(response, prompt_tokens, counter, model):
     chat_id = f"chatcmpl-{''.join(random.choice(string.ascii_letters + string.digits) for _ in range(29))}"
     system_fingerprint_list = model_system_fingerprint.get(model, None)
     system_fingerprint = random.choice(system_fingerprint_list) if system_fingerprint_list else None
     created_time = int(time.time())
-    all_text = ""
-    async for chunk in response:
-        try:
-            if chunk.startswith("data: [DONE]"):
-                break
-            elif not chunk.startswith("data: "):
-                continue
-            else:
-                chunk = json.loads(chunk[6:])
-                if not chunk["choices"][0].get("delta"):
-                    continue
-                all_text += chunk["choices"][0]["delta"]["content"]
-        except Exception as e:
-            logger.error(f"Error: {chunk}, error: {str(e)}")
-            continue
-    content, completion_tokens, finish_reason = await split_tokens_from_content(all_text, max_tokens, model)
+    texts = []
+    async for event in response:
+        if event is None:
+            break
+        content = event[0].get("content")
+        if content:
+            texts.append(content)
+    all_text = "".join(texts)
+    completion_tokens = counter.count
+    finish_reason = "length" if counter.exhausted else "stop"
     message = {
         "role": "assistant",
-        "content": content,
+        "content": all_text,
     }
     usage = {
         "prompt_tokens": prompt_tokens,
@@ -108,11 +108,21 @@ async def wss_stream_response(websocket, conversation_id):
             continue
 
 
+async def parse_upstream_events(chunks):
+    decoder = DeltaDecoder()
+    async for _, data in iter_sse_events(chunks):
+        if data[:1] == b"{":
+            try:
+                yield decoder.apply(json_utils.loads(data))
+            except Exception as e:
+                logger.error(f"Error: {bytes(data)}, details: {str(e)}")
+        elif data[:6] == b"[DONE]":
+            yield "[DONE]"
+
+
 async def head_process_response(response):
-    async for chunk in response:
-        chunk = chunk.decode("utf-8")
-        if chunk.startswith("data: {"):
-            chunk_old_data = json.loads(chunk[6:])
+    async for chunk_old_data in response:
+        if isinstance(chunk_old_data, dict):
             message = chunk_old_data.get("message", {})
             if not message and "error" in chunk_old_data:
                 return response, False
@@ -131,7 +141,37 @@ async def stream_response(service, response, model, max_tokens):
     system_fingerprint_list = model_system_fingerprint.get(model, None)
     system_fingerprint = random.choice(system_fingerprint_list) if system_fingerprint_list else None
     created_time = int(time.time())
-    completion_tokens = 0
+
+    encoder = ChunkEncoder(chat_id, created_time, model, system_fingerprint)
+    counter = StreamTokenCounter(model, max_tokens)
+    include_usage = (service.data.get("stream_options") or {}).get("include_usage", False)
+    ids = {}
+    yield encoder.encode({"role": "assistant", "content": ""})
+
+    async for event in response_deltas(service, response, counter):
+        if event is None:
+            if include_usage:
+                include_usage = False
+                yield encoder.encode_usage({
+                    "prompt_tokens": service.prompt_tokens,
+                    "completion_tokens": counter.count,
+                    "total_tokens": service.prompt_tokens + counter.count
+                })
+            yield "data: [DONE]\n\n"
+            continue
+        delta, finish_reason, message_id, conversation_id = event
+        if not service.history_disabled:
+            ids = {"message_id": message_id, "conversation_id": conversation_id}
+        yield encoder.encode(delta, finish_reason, **ids)
+
+
+async def response_deltas(service, response, counter):
+    """Turns upstream events into OpenAI-style deltas.
+
+    Yields `(delta, finish_reason, message_id, conversation_id)` tuples and
+    None where the output stream should emit `[DONE]`. Content is counted by
+    `counter` and cut off once it reaches its max_tokens.
+    """
     len_last_content = 0
     len_last_citation = 0
     last_message_id = None
@@ -140,34 +180,18 @@ async def stream_response(service, response, model, max_tokens):
     last_status = None
     model_slug = None
     end = False
+    prefetched_files = set()
+    reply = []
+    reply_ids = (None, None)
 
-    chunk_new_data = {
-        "id": chat_id,
-        "object": "chat.completion.chunk",
-        "created": created_time,
-        "model": model,
-        "choices": [
-            {
-                "index": 0,
-                "delta": {"role": "assistant", "content": ""},
-                "logprobs": None,
-                "finish_reason": None
-            }
-        ]
-    }
-    if system_fingerprint:
-        chunk_new_data["system_fingerprint"] = system_fingerprint
-    yield f"data: {json.dumps(chunk_new_data)}\n\n"
-
-    async for chunk in response:
-        chunk = chunk.decode("utf-8")
+    async for chunk_old_data in response:
         if end:
             logger.info(f"Response Model: {model_slug}")
-            yield "data: [DONE]\n\n"
+            service.remember_conversation("".join(reply), *reply_ids)
+            yield None
             break
         try:
-            if chunk.startswith("data: {"):
-                chunk_old_data = json.loads(chunk[6:])
+            if isinstance(chunk_old_data, dict):
                 finish_reason = None
                 message = chunk_old_data.get("message", {})
                 conversation_id = chunk_old_data.get("conversation_id")
@@ -236,12 +260,18 @@ async def stream_response(service, response, model, max_tokens):
                             full_height = part.get("height", 0)
                             current_height = part.get('metadata', {}).get("generation", {}).get("height", 0)
                             if full_height > current_height:
+                                # Start resolving as soon as the pointer shows up; only the final emit waits on it
+                                if file_id not in prefetched_files:
+                                    prefetched_files.add(file_id)
+                                    attachment_url_cache.resolve((conversation_id, file_id), service.get_attachment_url,
+                                                                 file_id, conversation_id)
                                 completed_rate = current_height / full_height
                                 new_text = f"\n> {completed_rate:.2%}\n"
                                 if last_role != role:
                                     new_text = f"\n```{new_text}"
                             else:
-                                image_download_url = await service.get_attachment_url(file_id, conversation_id)
+                                image_download_url = await attachment_url_cache.resolve(
+                                    (conversation_id, file_id), service.get_attachment_url, file_id, conversation_id)
                                 new_text = f"\n```\n![image]({image_download_url})\n"
                     else:
                         text = content.get("text", "")
@@ -264,43 +294,51 @@ async def stream_response(service, response, model, max_tokens):
 
                     delta = {"content": new_text}
                     last_content_type = outer_content_type
-                    if completion_tokens >= max_tokens:
-                        delta = {}
-                        finish_reason = "length"
-                        end = True
 
                 elif status == "finished_successfully":
                     if content.get("content_type") == "multimodal_text":
                         parts = content.get("parts", [])
                         delta = {}
+                        url_lookups = []
                         for part in parts:
-                            if isinstance(part, str):
+                            if not isinstance(part, dict) or part.get('content_type') != "image_asset_pointer":
                                 continue
-                            inner_content_type = part.get('content_type')
-                            if inner_content_type == "image_asset_pointer":
-                                last_content_type = "image_asset_pointer"
-                                if part.get('asset_pointer').startswith('file-service://'):
-                                    file_id = part.get('asset_pointer').replace('file-service://', '')
-                                    logger.debug(f"file_id: {file_id}")
-                                    image_download_url = await service.get_download_url(file_id)
-                                    logger.debug(f"image_download_url: {image_download_url}")
-                                    if image_download_url:
-                                        delta = {"content": f"\n```\n![image]({image_download_url})\n"}
-                                    else:
-                                        delta = {"content": f"\n```\nFailed to load the image.\n"}
+                            asset_pointer = part.get('asset_pointer')
+                            if asset_pointer.startswith('file-service://'):
+                                file_id = asset_pointer.replace('file-service://', '')
+                                logger.debug(f"file_id: {file_id}")
+                                url_lookups.append((True, attachment_url_cache.resolve(
+                                    (conversation_id, file_id), service.get_download_url, file_id)))
+                            else:
+                                file_id = asset_pointer.replace('sediment://', '')
+                                url_lookups.append((False, attachment_url_cache.resolve(
+                                    (conversation_id, file_id), service.get_attachment_url, file_id, conversation_id)))
+                        for from_file_service, url_lookup in url_lookups:
+                            last_content_type = "image_asset_pointer"
+                            image_download_url = await url_lookup
+                            if from_file_service:
+                                logger.debug(f"image_download_url: {image_download_url}")
+                                if image_download_url:
+                                    delta = {"content": f"\n```\n![image]({image_download_url})\n"}
                                 else:
-                                    file_id = part.get('asset_pointer').replace('sediment://', '')
-                                    image_download_url = await service.get_attachment_url(file_id, conversation_id)
-                                    delta = {"content": f"\n![image]({image_download_url})\n"}
+                                    delta = {"content": f"\n```\nFailed to load the image.\n"}
+                            else:
+                                delta = {"content": f"\n![image]({image_download_url})\n"}
                     elif message.get("end_turn"):
                         part = content.get("parts", [])[0]
                         new_text = part[len_last_content:]
                         if not new_text:
-                            matches = re.findall(r'\(sandbox:(.*?)\)', part)
+                            matches = re.findall(r'\(sandbox:(.*?)\)', str(part))
                             if matches:
                                 file_url_content = ""
-                                for i, sandbox_path in enumerate(matches):
-                                    file_download_url = await service.get_response_file_url(conversation_id, message_id, sandbox_path)
+                                url_lookups = [
+                                    attachment_url_cache.resolve((conversation_id, f"{message_id}:{sandbox_path}"),
+                                                                 service.get_response_file_url, conversation_id,
+                                                                 message_id, sandbox_path)
+                                    for sandbox_path in matches
+                                ]
+                                for i, url_lookup in enumerate(url_lookups):
+                                    file_download_url = await url_lookup
                                     if file_download_url:
                                         file_url_content += f"\n```\n\n![File {i+1}]({file_download_url})\n"
                                 delta = {"content": file_url_content}
@@ -321,30 +359,28 @@ async def stream_response(service, response, model, max_tokens):
                 last_message_id = message_id
                 last_role = role
                 last_status = status
+                if delta.get("content"):
+                    delta = {**delta, "content": counter.add(delta["content"])}
+                    if counter.exhausted:
+                        finish_reason = "length"
+                        end = True
                 if not end and not delta.get("content"):
                     delta = {"role": "assistant", "content": ""}
-                chunk_new_data["choices"][0]["delta"] = delta
-                chunk_new_data["choices"][0]["finish_reason"] = finish_reason
-                if not service.history_disabled:
-                    chunk_new_data.update({
-                        "message_id": message_id,
-                        "conversation_id": conversation_id,
-                    })
-                completion_tokens += 1
-                yield f"data: {json.dumps(chunk_new_data)}\n\n"
-            elif chunk.startswith("data: [DONE]"):
+                reply.append(delta.get("content", ""))
+                reply_ids = (message_id, conversation_id)
+                yield delta, finish_reason, message_id, conversation_id
+            elif chunk_old_data == "[DONE]":
                 logger.info(f"Response Model: {model_slug}")
-                yield "data: [DONE]\n\n"
+                service.remember_conversation("".join(reply), *reply_ids)
+                yield None
             else:
                 continue
         except Exception as e:
-            if chunk.startswith("data: "):
-                chunk_data = json.loads(chunk[6:])
-                if chunk_data.get("error"):
-                    logger.error(f"Error: {chunk_data.get('error')}")
-                    yield "data: [DONE]\n\n"
-                    break
-            logger.error(f"Error: {chunk}, details: {str(e)}")
+            if isinstance(chunk_old_data, dict) and chunk_old_data.get("error"):
+                logger.error(f"Error: {chunk_old_data.get('error')}")
+                yield None
+                break
+            logger.error(f"Error: {chunk_old_data}, details: {str(e)}")
             continue
 
 
@@ -388,15 +424,53 @@ def format_messages_with_url(content):
     return new_content
 
 
+async def upload_attachment(service, image_url, semaphore):
+    async with semaphore:
+        file_content, mime_type = await get_file_content(image_url.get("url"))
+        try:
+            file_meta = await service.upload_file(file_content, mime_type, image_url.get("detail", "auto"))
+        finally:
+            if file_content is not None:
+                file_content.close()
+        if file_meta and not file_meta["mime_type"].startswith("image/") and not file_meta["use_case"] == "ace_upload":
+            await service.check_upload(file_meta["file_id"])
+        return file_meta
+
+
+async def upload_attachments(service, image_urls):
+    """Fetch and upload every attachment concurrently, results in input order."""
+    if not image_urls:
+        return []
+    semaphore = asyncio.Semaphore(max(upload_concurrency, 1))
+    uploads = [asyncio.ensure_future(upload_attachment(service, image_url, semaphore)) for image_url in image_urls]
+    start_time = time.perf_counter()
+    try:
+        file_metas = await asyncio.gather(*uploads)
+    except BaseException:
+        for upload in uploads:
+            upload.cancel()
+        raise
+    logger.info(f"Uploaded {len(image_urls)} attachments in {time.perf_counter() - start_time:.2f}s")
+    return file_metas
+
+
 async def api_messages_to_chat(service, api_messages, upload_by_url=False):
     file_tokens = 0
     chat_messages = []
+    contents = []
     for api_message in api_messages:
-        role = api_message.get('role')
         content = api_message.get('content')
         if upload_by_url:
             if isinstance(content, str):
                 content = format_messages_with_url(content)
+        contents.append(content)
+    file_metas = iter(await upload_attachments(service, [
+        i.get("image_url")
+        for content in contents if isinstance(content, list)
+        for i in content if i.get("type") == "image_url"
+    ]))
+    for api_message, content in zip(api_messages, contents):
+        role = api_message.get('role')
         if isinstance(content, list):
             parts = []
             attachments = []
@@ -406,16 +480,13 @@ async def api_messages_to_chat(service, api_messages, upload_by_url=False):
                     parts.append(i.get("text"))
                 elif i.get("type") == "image_url":
                     image_url = i.get("image_url")
-                    url = image_url.get("url")
                     detail = image_url.get("detail", "auto")
-                    file_content, mime_type = await get_file_content(url)
-                    file_meta = await service.upload_file(file_content, mime_type)
+                    file_meta = next(file_metas)
                     if file_meta:
                         file_id = file_meta["file_id"]
                         file_size = file_meta["size_bytes"]
                         file_name = file_meta["file_name"]
                         mime_type = file_meta["mime_type"]
-                        use_case = file_meta["use_case"]
                         if mime_type.startswith("image/"):
                             width, height = file_meta["width"], file_meta["height"]
                             file_tokens += await calculate_image_tokens(width, height, detail)
@@ -435,8 +506,6 @@ async def api_messages_to_chat(service, api_messages, upload_by_url=False):
                                 "height": height
                             })
                         else:
-                            if not use_case == "ace_upload":
-                                await service.check_upload(file_id)
                             file_tokens += file_size // 1000
                             attachments.append({
                                 "id": file_id,
@@ -1,5 +1,4 @@
 import asyncio
-import json
 import random
 import re
 import string
@@ -13,7 +12,9 @@ from fastapi import HTTPException
 from api.files import get_file_content
 from api.models import model_system_fingerprint
 from api.tokens import split_tokens_from_content, calculate_image_tokens, num_tokens_from_messages
+from utils import json_utils
 from utils.Logger import logger
+from utils.sse import iter_sse_events
 
 moderation_message = "I'm sorry, I cannot provide or engage in any content related to pornography, violence, or any unethical material. If you have any other questions or need assistance, please feel free to let me know. I'll do my best to provide support and assistance."
 
@@ -31,7 +32,7 @@ async def format_not_stream_response(response, prompt_tokens, max_tokens, model)
             elif not chunk.startswith("data: "):
                 continue
             else:
-                chunk = json.loads(chunk[6:])
+                chunk = json_utils.loads(chunk[6:])
                 if not chunk["choices"][0].get("delta"):
                     continue
                 all_text += chunk["choices"][0]["delta"]["content"]
@@ -72,10 +73,10 @@ async def format_not_stream_response(response, prompt_tokens, max_tokens, model)
 
 
 async def head_process_response(response):
-    async for chunk in response:
-        chunk = chunk.decode("utf-8")
-        if chunk.startswith("data: {"):
-            chunk_old_data = json.loads(chunk[6:])
+    response = iter_sse_events(response)
+    async for _, data in response:
+        if data[:1] == b"{":
+            chunk_old_data = json_utils.loads(data)
             message = chunk_old_data.get("message", {})
             if not message and "error" in chunk_old_data:
                 return response, False
@@ -107,15 +108,14 @@ async def stream_response(service, response, model, max_tokens):
             }
         ]
     }
-    yield f"data: {json.dumps(chunk_new_data)}\n\n"
+    yield f"data: {json_utils.dumps(chunk_new_data)}\n\n"
 
-    async for chunk in response:
-        chunk = chunk.decode("utf-8")
+    async for _, data in response:
         try:
-            if chunk.startswith("data: {"):
-                chunk_old_data = json.loads(chunk[6:].strip())
+            if data[:1] == b"{":
+                chunk_old_data = json_utils.loads(data)
         except Exception as e:
-            logger.error(f"Error: {chunk}, error: {str(e)}")
+            logger.error(f"Error: {bytes(data)}, error: {str(e)}")
             continue
 
 
@@ -180,7 +180,11 @@ async def api_messages_to_chat(service, api_messages, upload_by_url=False):
                     url = image_url.get("url")
                     detail = image_url.get("detail", "auto")
                     file_content, mime_type = await get_file_content(url)
-                    file_meta = await service.upload_file(file_content, mime_type)
+                    try:
+                        file_meta = await service.upload_file(file_content, mime_type)
+                    finally:
+                        if file_content is not None:
+                            file_content.close()
                     if file_meta:
                         file_id = file_meta["file_id"]
                         file_size = file_meta["size_bytes"]
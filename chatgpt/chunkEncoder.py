@@ -0,0 +1,42 @@
+from json.encoder import encode_basestring
+
+from utils import json_utils
+
+
+class ChunkEncoder:
+    """Serializes `chat.completion.chunk` SSE lines from a per-response template.
+
+    The id, created, model and fingerprint fields never change within one
+    response, so they are encoded once into a prefix and suffix; each chunk
+    only escapes its delta and finish_reason. The output is byte-identical to
+    `json_utils.dumps` of the full chunk dict.
+    """
+
+    def __init__(self, chat_id, created_time, model, system_fingerprint=None):
+        head = json_utils.dumps({"id": chat_id, "object": "chat.completion.chunk", "created": created_time,
+                                 "model": model})
+        self.prefix = f'data: {head[:-1]},"choices":[{{"index":0,"delta":'
+        self.usage_prefix = f'data: {head[:-1]},"choices":[]'
+        self.suffix = ']'
+        if system_fingerprint:
+            self.suffix += f',"system_fingerprint":{encode_basestring(system_fingerprint)}'
+        self.content_tail = '},"logprobs":null,"finish_reason":null}' + self.suffix + '}\n\n'
+
+    @staticmethod
+    def encode_delta(delta):
+        if len(delta) == 1 and isinstance(delta.get("content"), str):
+            return '{"content":' + encode_basestring(delta["content"]) + '}'
+        return json_utils.dumps(delta)
+
+    def encode_content(self, content):
+        return self.prefix + '{"content":' + encode_basestring(content) + self.content_tail
+
+    def encode(self, delta, finish_reason=None, **extra):
+        if not extra and finish_reason is None and len(delta) == 1 and isinstance(delta.get("content"), str):
+            return self.encode_content(delta["content"])
+        finish = "null" if finish_reason is None else encode_basestring(finish_reason)
+        tail = "".join(f',{encode_basestring(key)}:{json_utils.dumps(value)}' for key, value in extra.items())
+        return f'{self.prefix}{self.encode_delta(delta)},"logprobs":null,"finish_reason":{finish}}}{self.suffix}{tail}}}\n\n'
+
+    def encode_usage(self, usage):
+        return f'{self.usage_prefix}{self.suffix[1:]},"usage":{json_utils.dumps(usage)}}}\n\n'
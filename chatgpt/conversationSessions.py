@@ -0,0 +1,69 @@
+import hashlib
+import json
+import time
+from collections import OrderedDict
+
+from utils.configs import conversation_cache, conversation_cache_size, conversation_cache_ttl
+
+
+class ConversationSessions:
+    """Maps an OpenAI message history to the upstream conversation it produced.
+
+    After a reply, the history plus that reply is hashed and remembered with
+    the (conversation_id, message_id, token) it ended on. A follow-up whose
+    messages start with a remembered history continues that conversation and
+    only sends the turns after it, instead of replaying and re-uploading the
+    whole chat into a new one.
+    """
+
+    def __init__(self, enabled=False, max_size=1024, ttl=3600):
+        self.enabled = enabled
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(req_token, messages):
+        history = [{"role": message.get("role"), "content": message.get("content")} for message in messages]
+        payload = json.dumps([req_token, history], sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    def lookup(self, req_token, messages):
+        """Returns (conversation_id, message_id, prefix, new_messages) or None."""
+        last_reply = max((i for i, message in enumerate(messages) if message.get("role") == "assistant"), default=-1)
+        if last_reply < 0 or last_reply == len(messages) - 1:
+            return None
+        prefix, new_messages = messages[:last_reply + 1], messages[last_reply + 1:]
+        key = self.key(req_token, prefix)
+        entry = self._entries.get(key)
+        if entry is None or entry[0] <= time.time() or entry[3] != req_token:
+            self._entries.pop(key, None)
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._entries.move_to_end(key)
+        _, conversation_id, message_id, _ = entry
+        return conversation_id, message_id, prefix, new_messages
+
+    def record(self, req_token, messages, reply, conversation_id, message_id):
+        if not conversation_id or not message_id:
+            return
+        key = self.key(req_token, [*messages, {"role": "assistant", "content": reply}])
+        self._entries[key] = (time.time() + self.ttl, conversation_id, message_id, req_token)
+        self._entries.move_to_end(key)
+        if len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+        }
+
+
+conversation_sessions = ConversationSessions(conversation_cache, conversation_cache_size, conversation_cache_ttl)
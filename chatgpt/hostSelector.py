@@ -0,0 +1,116 @@
+import random
+import time
+from collections import deque
+
+from utils.configs import chatgpt_base_url_list, host_eject_cooldown, host_eject_failures
+from utils.Logger import logger
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class HostSelector:
+    """Routes requests to the configured base URL with the best recent record.
+
+    Every host keeps an EWMA of its time-to-first-byte and of its error rate,
+    and is picked with a probability inversely proportional to the resulting
+    score, so the fastest host gets most requests while a host that was slow
+    once still sees enough traffic to show it has recovered. After
+    `eject_failures` consecutive failures a host is ejected for `cooldown`
+    seconds, then a single half-open trial request decides whether it rejoins
+    the rotation or is ejected again.
+    """
+
+    def __init__(self, hosts, eject_failures=3, cooldown=30, alpha=0.3):
+        self.hosts = hosts or ["https://chatgpt.com"]
+        self.eject_failures = eject_failures
+        self.cooldown = cooldown
+        self.alpha = alpha
+        self.stats = {host: {"ttfb": None, "error_rate": 0.0, "failures": 0, "state": CLOSED, "opened_at": 0,
+                             "trial_at": 0, "requests": 0, "selected": 0} for host in self.hosts}
+        self.samples = deque(maxlen=200)
+
+    def _score(self, host):
+        stat = self.stats[host]
+        if stat["ttfb"] is None:
+            return 0
+        return stat["ttfb"] * (1 + 4 * stat["error_rate"])
+
+    def _available(self, host, now):
+        stat = self.stats[host]
+        if stat["state"] == CLOSED:
+            return True
+        if stat["state"] == OPEN and now - stat["opened_at"] >= self.cooldown:
+            stat["state"] = HALF_OPEN
+            stat["trial_at"] = 0
+        # Only one trial request at a time; a lost trial frees up after a cooldown
+        return stat["state"] == HALF_OPEN and now - stat["trial_at"] >= self.cooldown
+
+    def select(self, exclude=None):
+        if len(self.hosts) == 1:
+            return self.hosts[0]
+        now = time.monotonic()
+        candidates = [host for host in self.hosts if host != exclude and self._available(host, now)]
+        if not candidates:
+            candidates = [host for host in self.hosts if host != exclude] or self.hosts
+            host = min(candidates, key=lambda h: self.stats[h]["opened_at"])
+        elif any(self.stats[host]["state"] == HALF_OPEN for host in candidates):
+            host = next(host for host in candidates if self.stats[host]["state"] == HALF_OPEN)
+        else:
+            unmeasured = [host for host in candidates if self.stats[host]["ttfb"] is None]
+            if unmeasured:
+                host = random.choice(unmeasured)
+            else:
+                # Slower hosts keep a share of traffic so their EWMA can recover
+                weights = [1 / max(self._score(host), 1) for host in candidates]
+                host = random.choices(candidates, weights=weights)[0]
+        if self.stats[host]["state"] == HALF_OPEN:
+            self.stats[host]["trial_at"] = now
+        self.stats[host]["selected"] += 1
+        return host
+
+    def record(self, host, ttfb=None, error=False):
+        stat = self.stats.get(host)
+        if stat is None:
+            return
+        stat["requests"] += 1
+        stat["error_rate"] = self.alpha * (1.0 if error else 0.0) + (1 - self.alpha) * stat["error_rate"]
+        if error:
+            stat["failures"] += 1
+            if stat["state"] == HALF_OPEN or stat["failures"] >= self.eject_failures:
+                if stat["state"] != OPEN:
+                    logger.warning(f"Upstream {host} ejected for {self.cooldown}s after {stat['failures']} failure(s)")
+                stat["state"] = OPEN
+                stat["opened_at"] = time.monotonic()
+            return
+        if ttfb is not None:
+            self.samples.append(ttfb)
+            stat["ttfb"] = ttfb if stat["ttfb"] is None else self.alpha * ttfb + (1 - self.alpha) * stat["ttfb"]
+        if stat["state"] != CLOSED:
+            logger.info(f"Upstream {host} recovered")
+        stat["failures"] = 0
+        stat["state"] = CLOSED
+
+    def ttfb_percentile(self, percentile, default=None):
+        if not self.samples:
+            return default
+        samples = sorted(self.samples)
+        return samples[min(int(len(samples) * percentile / 100), len(samples) - 1)]
+
+    def get_stats(self):
+        return {
+            host: {
+                "state": stat["state"],
+                "ttfb": round(stat["ttfb"], 2) if stat["ttfb"] is not None else None,
+                "error_rate": round(stat["error_rate"], 4),
+                "failures": stat["failures"],
+                "requests": stat["requests"],
+                "selected": stat["selected"],
+                "score": round(self._score(host), 2),
+            }
+            for host, stat in self.stats.items()
+        }
+
+
+host_selector = HostSelector(chatgpt_base_url_list, eject_failures=host_eject_failures, cooldown=host_eject_cooldown)
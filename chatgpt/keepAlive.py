@@ -0,0 +1,97 @@
+import asyncio
+import hashlib
+import time
+
+import utils.globals as globals
+from utils.Client import client_pool
+from utils.configs import chatgpt_base_url_list, keep_alive_interval, prewarm_connections
+from utils.Logger import logger
+
+
+class KeepAliveManager:
+    """Keeps warm upstream connections to every configured base URL.
+
+    The pooled clients used by known fingerprints are held open for the whole
+    process lifetime and probed with a lightweight HEAD request every
+    `interval` seconds, so neither startup nor an idle period leaves the first
+    real request paying for DNS, TCP and TLS setup.
+    """
+
+    def __init__(self, hosts, connections=0, interval=60, timeout=5):
+        self.hosts = hosts or ["https://chatgpt.com"]
+        self.connections = connections
+        self.interval = interval
+        self.timeout = timeout
+        self.status = {host: {"ready": False, "latency": None, "status_code": None, "last_checked": None, "error": None}
+                       for host in self.hosts}
+        self._clients = []
+        self._task = None
+
+    def _warm_keys(self):
+        keys = []
+        for req_token, fp in globals.fp_map.items():
+            impersonate = fp.get("impersonate", "safari15_3")
+            proxy_url = fp.get("proxy_url")
+            if proxy_url:
+                proxy_url = proxy_url.replace("{}", hashlib.md5(req_token.encode()).hexdigest())
+            if (proxy_url, impersonate) not in keys:
+                keys.append((proxy_url, impersonate))
+        if not keys:
+            keys.append((None, "safari15_3"))
+        return keys[:max(client_pool.max_size // 2, 1)]
+
+    async def _probe(self, client, host):
+        start = time.monotonic()
+        try:
+            r = await client.request("HEAD", f"{host}/", timeout=self.timeout, allow_redirects=False)
+            return r.status_code, (time.monotonic() - start) * 1000, None
+        except Exception as e:
+            return None, None, str(e)
+
+    async def check(self):
+        for host in self.hosts:
+            probes = [self._probe(client, host) for client in self._clients for _ in range(self.connections)]
+            results = await asyncio.gather(*probes)
+            latencies = [latency for status_code, latency, _ in results if status_code and status_code < 500]
+            status_code, _, error = results[-1] if results else (None, None, None)
+            self.status[host] = {
+                "ready": bool(latencies),
+                "latency": round(min(latencies), 2) if latencies else None,
+                "status_code": status_code,
+                "last_checked": int(time.time()),
+                "error": None if latencies else error,
+            }
+            if not latencies:
+                logger.warning(f"Upstream {host} is not ready: {error or status_code}")
+
+    async def _run(self):
+        while True:
+            try:
+                await self.check()
+            except Exception as e:
+                logger.error(f"Keep-alive check failed: {e}")
+            await asyncio.sleep(self.interval)
+
+    async def start(self):
+        if self.connections <= 0 or self._task:
+            return
+        for proxy, impersonate in self._warm_keys():
+            self._clients.append(await client_pool.acquire(proxy=proxy, impersonate=impersonate))
+        logger.info(f"Prewarming {self.connections} connection(s) x {len(self._clients)} client(s) "
+                    f"to {len(self.hosts)} host(s)")
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+        for client in self._clients:
+            await client_pool.release(client)
+        self._clients = []
+
+    def is_ready(self, host):
+        return self.status.get(host, {}).get("ready", False)
+
+
+keep_alive_manager = KeepAliveManager(chatgpt_base_url_list, connections=prewarm_connections,
+                                      interval=keep_alive_interval)
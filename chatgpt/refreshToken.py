@@ -4,7 +4,7 @@ import time
 
 from fastapi import HTTPException
 
-from utils.Client import Client
+from utils.Client import client_pool
 from utils.Logger import logger
 from utils.configs import proxy_url_list
 from utils.database import get_db_context
@@ -90,7 +90,7 @@ async def chat_refresh(refresh_token):
     }
     session_id = hashlib.md5(refresh_token.encode()).hexdigest()
     proxy_url = random.choice(proxy_url_list).replace("{}", session_id) if proxy_url_list else None
-    client = Client(proxy=proxy_url)
+    client = await client_pool.acquire(proxy=proxy_url)
     try:
         r = await client.post("https://auth0.openai.com/oauth/token", json=data, timeout=15)
         if r.status_code == 200:
@@ -108,5 +108,4 @@ async def chat_refresh(refresh_token):
         logger.error(f"Failed to refresh access_token `{refresh_token}`: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Failed to refresh access_token.")
     finally:
-        await client.close()
-        del client
+        await client_pool.release(client)
@@ -0,0 +1,72 @@
+import hashlib
+
+import diskcache as dc
+from starlette.concurrency import run_in_threadpool
+
+from utils.configs import upload_cache, upload_cache_size, upload_cache_ttl
+from utils.Logger import logger
+
+
+class UploadCache:
+    """Remembers uploaded files by (account, sha256 of content).
+
+    Clients resend the same attachments on every turn; a hit returns the
+    earlier file_meta so the get_upload_url/PUT/uploaded round trips are
+    skipped entirely. Backed by diskcache so it survives restarts.
+    """
+
+    def __init__(self, enabled=False, ttl=86400, directory='./data/upload_cache', size_limit=64 * 1024 * 1024):
+        self.enabled = enabled
+        self.ttl = ttl
+        self.directory = directory
+        self.size_limit = size_limit
+        self._cache = None
+        self.hits = 0
+        self.misses = 0
+        self.bytes_saved = 0
+
+    @property
+    def cache(self):
+        if self._cache is None:
+            self._cache = dc.Cache(self.directory, size_limit=self.size_limit, eviction_policy='least-recently-used')
+        return self._cache
+
+    @staticmethod
+    def key(req_token, account_id, sha256):
+        account = hashlib.md5(f"{req_token}:{account_id}".encode()).hexdigest()
+        return f"{account}:{sha256}"
+
+    async def get(self, req_token, account_id, sha256):
+        """Returns (key, cached file_meta or None)."""
+        key = self.key(req_token, account_id, sha256)
+        try:
+            file_meta = await run_in_threadpool(self.cache.get, key)
+        except Exception as e:
+            logger.warning(f"Upload cache read failed: {e}")
+            file_meta = None
+        if file_meta is None:
+            self.misses += 1
+            return key, None
+        self.hits += 1
+        self.bytes_saved += file_meta["size_bytes"]
+        logger.info(f"Upload cache hit: {file_meta['file_id']}, saved {file_meta['size_bytes']} bytes")
+        return key, file_meta
+
+    async def set(self, key, file_meta):
+        try:
+            await run_in_threadpool(self.cache.set, key, file_meta, expire=self.ttl)
+        except Exception as e:
+            logger.warning(f"Upload cache write failed: {e}")
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "enabled": self.enabled,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            "bytes_saved": self.bytes_saved,
+        }
+
+
+upload_cache = UploadCache(upload_cache, upload_cache_ttl, size_limit=upload_cache_size)
@@ -24,6 +24,7 @@ from utils.Logger import logger
 from utils.configs import x_sign, turnstile_solver_url, chatgpt_base_url_list, no_sentinel, sentinel_proxy_url_list, \
     force_no_history
 from utils.database import get_db_context
+from utils.sse import close_stream
 
 banned_paths = [
     "backend-api/accounts/logout_all",
@@ -663,8 +664,9 @@ if no_sentinel:
             rheaders.update({"x-sign": x_sign})
         if 'stream' in rheaders.get("content-type", ""):
             conv_key = r.cookies.get("conv_key", "")
-            response = StreamingResponse(content_generator(r, token, history), headers=rheaders,
-                                         media_type=r.headers.get("content-type", ""), background=background)
+            content = content_generator(r, token, history)
+            response = StreamingResponse(content, headers=rheaders, media_type=r.headers.get("content-type", ""),
+                                         background=BackgroundTask(close_stream, content, background))
             response.set_cookie("conv_key", value=conv_key)
             return response
         else:
@@ -7,6 +7,7 @@ from fastapi.responses import HTMLResponse
 
 from app import app, templates
 from apps.user.views import login_page
+from utils import json_utils
 from utils.kv_utils import set_value_for_key_list
 from utils.database import get_db
 from apps.token.operations import get_available_token
@@ -38,8 +39,8 @@ async def chatgpt_html(request: Request, db=Depends(get_db)):
         if accept_language:
             set_value_for_key_list(user_chatgpt_context_1, "locale", accept_language.split(",")[0])
 
-    user_chatgpt_context_1 = json.dumps(user_chatgpt_context_1, separators=(',', ':'), ensure_ascii=False)
-    user_chatgpt_context_2 = json.dumps(user_chatgpt_context_2, separators=(',', ':'), ensure_ascii=False)
+    user_chatgpt_context_1 = json_utils.dumps(user_chatgpt_context_1)
+    user_chatgpt_context_2 = json_utils.dumps(user_chatgpt_context_2)
 
     escaped_context_1 = user_chatgpt_context_1.replace("\\", "\\\\").replace('"', '\\"')
     escaped_context_2 = user_chatgpt_context_2.replace("\\", "\\\\").replace('"', '\\"')
@@ -1,3 +1,4 @@
+import asyncio
 import hashlib
 import json
 import random
@@ -11,10 +12,13 @@ from starlette.background import BackgroundTask
 from apps.token.operations import mark_token_as_error, get_available_token
 from chatgpt.authorization import verify_token, get_req_token
 from chatgpt.fp import get_fp
-from utils.Client import Client
+from chatgpt.hostSelector import host_selector
+from utils.Client import client_pool, abort_response, iter_stream
 from utils.database import get_db, get_db_context
 from utils.Logger import logger
-from utils.configs import chatgpt_base_url_list, sentinel_proxy_url_list, force_no_history, file_host, voice_host
+from utils.sse import guard_stream, close_stream
+from utils.configs import sentinel_proxy_url_list, force_no_history, file_host, voice_host, hedge_requests, \
+    hedge_percentile
 
 def generate_current_time():
     current_time = datetime.now(timezone.utc)
@@ -118,10 +122,73 @@ def save_conversation(token, conversation_id, title=None):
 
 async def content_generator(r, token, history=True):
     # TODO: 移除對話保存邏輯，只保留内容生成，未來支援 db 儲存再進行修改
-    async for chunk in r.aiter_content():
+    async for chunk in guard_stream(iter_stream(r), lambda: abort_response(r)):
         yield chunk
 
 
+async def timed_request(client, method, base_url, path, headers, **kwargs):
+    start = time.monotonic()
+    try:
+        r = await client.request(method, f"{base_url}/{path}", headers=headers, **kwargs)
+    except Exception:
+        host_selector.record(base_url, error=True)
+        raise
+    host_selector.record(base_url, ttfb=(time.monotonic() - start) * 1000, error=r.status_code >= 500)
+    return r
+
+
+def discard_response(task):
+    """Abort the transfer of a losing hedge once its headers are in.
+
+    Cancelling the task would only stop waiting for headers while curl keeps
+    downloading the body; aborting lets curl drop the connection and release
+    its handle on its own.
+    """
+    if not task.cancelled() and task.exception() is None:
+        abort_response(task.result())
+
+
+async def hedged_request(client, base_url, path, headers, **kwargs):
+    """Send an idempotent GET and hedge it against another host if it is slow.
+
+    If no headers arrive within the configured percentile of recent
+    time-to-first-byte, a second attempt goes to another base URL (or the same
+    host for CDN paths). The first response wins and the loser is aborted.
+    """
+    first = asyncio.create_task(timed_request(client, "GET", base_url, path, headers, **kwargs))
+    pending = {first}
+    try:
+        delay = host_selector.ttfb_percentile(hedge_percentile, default=1000) / 1000
+        done, pending = await asyncio.wait(pending, timeout=delay)
+        if done:
+            return first.result(), base_url
+
+        hedge_url = host_selector.select(exclude=base_url) if base_url in host_selector.hosts else base_url
+        hedge_host = hedge_url.replace("https://", "").replace("http://", "")
+        hedge_headers = headers.copy()
+        hedge_headers.update({"host": hedge_host, "origin": hedge_url, "referer": f"{hedge_url}/"})
+        logger.info(f"Hedging GET {path}: {base_url} -> {hedge_url} after {delay * 1000:.0f}ms")
+        second = asyncio.create_task(timed_request(client, "GET", hedge_url, path, hedge_headers, **kwargs))
+
+        tasks = {first: base_url, second: hedge_url}
+        pending = set(tasks)
+        error = None
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            winners = [task for task in done if task.exception() is None]
+            if not winners:
+                error = error or next(iter(done)).exception()
+                continue
+            for task in winners[1:]:
+                discard_response(task)
+            return winners[0].result(), tasks[winners[0]]
+        raise error
+    finally:
+        # Attempts still waiting on headers are aborted when they get them
+        for task in pending:
+            task.add_done_callback(discard_response)
+
+
 async def chatgpt_reverse_proxy(request: Request, path: str):
     # TODO: 加入 pipeline
 
@@ -152,7 +219,7 @@ async def chatgpt_reverse_proxy(request: Request, path: str):
             if (key.lower() in headers_accept_list)
         }
 
-        base_url = random.choice(chatgpt_base_url_list) if chatgpt_base_url_list else "https://chatgpt.com"
+        base_url = None
         if "assets/" in path:
             base_url = "https://cdn.oaistatic.com"
         if "file-" in path and "backend-api" not in path:
@@ -162,6 +229,8 @@ async def chatgpt_reverse_proxy(request: Request, path: str):
         if "sandbox" in path:
             base_url = "https://web-sandbox.oaiusercontent.com"
             path = path.replace("sandbox/", "")
+        if not base_url:
+            base_url = host_selector.select()
 
         token = headers.get("authorization", "").replace("Bearer ", "").strip()
         if token:
@@ -214,14 +283,18 @@ async def chatgpt_reverse_proxy(request: Request, path: str):
 
         if "backend-api/sentinel/chat-requirements" in path and sentinel_proxy_url_list:
             sentinel_proxy_url = random.choice(sentinel_proxy_url_list).replace("{}", session_id) if sentinel_proxy_url_list else None
-            client = Client(proxy=sentinel_proxy_url)
+            client = await client_pool.acquire(proxy=sentinel_proxy_url)
         else:
             proxy_url = proxy_url.replace("{}", session_id) if proxy_url else None
-            client = Client(proxy=proxy_url, impersonate=impersonate)
+            client = await client_pool.acquire(proxy=proxy_url, impersonate=impersonate)
         try:
-            background = BackgroundTask(client.close)
-            r = await client.request(request.method, f"{base_url}/{path}", params=params, headers=headers,
-                                     cookies=request_cookies, data=data, stream=True, allow_redirects=False)
+            background = BackgroundTask(client_pool.release, client)
+            if hedge_requests and request.method == "GET":
+                r, base_url = await hedged_request(client, base_url, path, headers, params=params,
+                                                   cookies=request_cookies, stream=True, allow_redirects=False)
+            else:
+                r = await timed_request(client, request.method, base_url, path, headers, params=params,
+                                        cookies=request_cookies, data=data, stream=True, allow_redirects=False)
             
             # 針對 backend-api 請求的 401 錯誤特別處理
             if is_backend_api and r.status_code == 401:
@@ -240,8 +313,9 @@ async def chatgpt_reverse_proxy(request: Request, path: str):
                 logger.info(f"Request UA: {user_agent}")
                 logger.info(f"Request impersonate: {impersonate}")
                 conv_key = r.cookies.get("conv_key", "")
-                response = StreamingResponse(content_generator(r, token, history), media_type=r.headers.get("content-type", ""),
-                                  background=background)
+                content = content_generator(r, token, history)
+                response = StreamingResponse(content, media_type=r.headers.get("content-type", ""),
+                                             background=BackgroundTask(close_stream, content, background))
                 response.set_cookie("conv_key", value=conv_key)
                 return response
             elif 'image' in r.headers.get("content-type", "") or "audio" in r.headers.get("content-type", "") or "video" in r.headers.get("content-type", ""):
@@ -290,7 +364,7 @@ async def chatgpt_reverse_proxy(request: Request, path: str):
                                         status_code=r.status_code, background=background)
                 return response
         except Exception as e:
-            await client.close()
+            await client_pool.release(client)
     except HTTPException as e:
         raise e
     except Exception as e:
@@ -5,6 +5,7 @@ from fastapi.responses import Response
 
 from app import app
 from gateway.reverseProxy import chatgpt_reverse_proxy
+from utils import json_utils
 from utils.kv_utils import set_value_for_key_dict
 
 with open("templates/initialize.json", "r") as f:
@@ -16,13 +17,12 @@ async def initialize(request: Request):
     initialize_response = (await chatgpt_reverse_proxy(request, f"v1/initialize"))
     if not initialize_response:
         return Response(status_code=204)
-    initialize_str = initialize_response.body.decode('utf-8')
-    if not initialize_str:
+    if not initialize_response.body:
         return Response(status_code=204)
-    initialize_json = json.loads(initialize_str)
+    initialize_json = json_utils.loads(initialize_response.body)
     set_value_for_key_dict(initialize_json, "ip", "8.8.8.8")
     set_value_for_key_dict(initialize_json, "country", "US")
-    return Response(content=json.dumps(initialize_json, indent=4), media_type="application/json")
+    return Response(content=json_utils.dumps(initialize_json), media_type="application/json")
 
 
 @app.post("/v1/rgstr")
@@ -1,13 +1,14 @@
 import argparse
 import os
-import sys
 import subprocess
+import sys
+import time
 
 # Add the current directory to the path
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 
-from utils.database import init_db, SessionLocal
 from apps.user.operations import UserOperation
+from utils.database import SessionLocal, init_db
 
 
 def create_admin_user(name, email, password):
@@ -70,6 +71,210 @@ def run_initdb(args):
     print("Database initialized.")
 
 
+def benchmark_json(iterations):
+    """Report per-chunk decode/encode cost of every available JSON backend"""
+    from utils.json_utils import backends
+
+    upstream_event = (
+        b'{"p": "/message/content/parts/0", "o": "append", "v": "Hello, \\u4f60\\u597d! This is a streamed token."}'
+    )
+    legacy_event = (
+        b'{"message": {"id": "5e8f", "author": {"role": "assistant"}, "content": {"content_type": "text", "parts": ["'
+        + "lorem ipsum ".encode() * 200 + b'"]}, "status": "in_progress", "metadata": {"model_slug": "gpt-4o"}}, '
+        b'"conversation_id": "67a0", "error": null}'
+    )
+    chunk = {
+        "id": "chatcmpl-8fJ2kq0pZ7yM1vTqXnR4sLbCwE9aD", "object": "chat.completion.chunk", "created": 1700000000,
+        "model": "gpt-4o", "choices": [{"index": 0, "delta": {"content": "Hello, 你好!"}, "logprobs": None,
+                                         "finish_reason": None}], "system_fingerprint": "fp_44709d6fcb",
+    }
+    for name, (loads, dumps) in backends.items():
+        results = []
+        for label, func, arg in (
+            ("decode delta event", loads, memoryview(upstream_event)),
+            ("decode full message event", loads, memoryview(legacy_event)),
+            ("encode output chunk", dumps, chunk),
+        ):
+            start = time.perf_counter()
+            for _ in range(iterations):
+                func(arg)
+            results.append(f"{label}: {(time.perf_counter() - start) / iterations * 1e6:.2f}us")
+        print(f"{name:8} " + " | ".join(results))
+
+
+def benchmark_tokenizer(iterations):
+    """Report event-loop stall while counting a large prompt, inline vs offloaded"""
+    import asyncio
+
+    from api.tokens import (
+        num_tokens_from_messages,
+        token_count_cache,
+        tokenizer_pool,
+        tokenizer_registry,
+    )
+
+    tokenizer_registry.load()
+    token_count_cache.max_size = 0
+    messages = [
+        {"role": "system", "content": "You are a helpful assistant."},
+        {"role": "user", "content": "The quick brown fox jumps over the lazy dog. 敏捷的棕色狐狸。\n" * 8000},
+    ]
+
+    async def measure(threshold):
+        tokenizer_pool.threshold = threshold
+        stalls = []
+        done = False
+
+        async def ticker():
+            while not done:
+                start = time.perf_counter()
+                await asyncio.sleep(0.001)
+                stalls.append(time.perf_counter() - start - 0.001)
+
+        task = asyncio.create_task(ticker())
+        await asyncio.sleep(0.01)
+        start = time.perf_counter()
+        for _ in range(iterations):
+            num_tokens = await num_tokens_from_messages(messages, "gpt-4o")
+        elapsed = time.perf_counter() - start
+        done = True
+        await task
+        return num_tokens, elapsed, max(stalls)
+
+    for label, threshold in (("inline", float("inf")), ("offloaded", 0)):
+        num_tokens, elapsed, stall = asyncio.run(measure(threshold))
+        print(f"{label:10} {num_tokens} tokens | {elapsed / iterations * 1e3:.1f}ms per prompt | "
+              f"max event-loop stall: {stall * 1e3:.1f}ms")
+    tokenizer_pool.close()
+
+
+def generate_sse_streams(events):
+    """A legacy stream resending the whole message per event and its v1 delta equivalent"""
+    import json
+
+    words = [f"word{i % 50} " for i in range(events)]
+    message = {"id": "5e8f", "author": {"role": "assistant"}, "content": {"content_type": "text", "parts": [""]},
+               "status": "in_progress", "metadata": {"model_slug": "gpt-4o"}, "recipient": "all"}
+    legacy, text = [], ""
+    for word in words:
+        text += word
+        message["content"]["parts"] = [text]
+        legacy.append(b"data: " + json.dumps({"message": message, "conversation_id": "67a0", "error": None}).encode())
+    message["content"]["parts"] = [""]
+    v1 = [b'event: delta_encoding\ndata: "v1"',
+          b"event: delta\ndata: " + json.dumps({"p": "", "o": "add", "v": {"message": message, "conversation_id": "67a0"},
+                                                "c": 0}).encode(),
+          b"event: delta\ndata: " + json.dumps({"p": "/message/content/parts/0", "o": "append", "v": words[0]}).encode()]
+    v1 += [b"event: delta\ndata: " + json.dumps({"v": word}).encode() for word in words[1:]]
+    return {"legacy": b"\n\n".join(legacy + [b"data: [DONE]"]) + b"\n\n",
+            "v1": b"\n\n".join(v1 + [b"data: [DONE]"]) + b"\n\n"}
+
+
+def benchmark_sse(iterations, events=2000, chunk_size=1024):
+    """Report per-event cost of parsing upstream SSE, old line-based path vs iter_sse_events"""
+    import asyncio
+    import json
+
+    from curl_cffi.requests.models import Response
+
+    from utils import json_utils
+    from utils.sse import iter_sse_events
+
+    async def chunks(raw):
+        for i in range(0, len(raw), chunk_size):
+            yield raw[i:i + chunk_size]
+
+    async def old_path(raw):
+        r = Response()
+        r.aiter_content = lambda **kwargs: chunks(raw)
+        async for line in r.aiter_lines():
+            line = line.decode("utf-8")
+            if line.startswith("data: {"):
+                json.loads(line[6:])
+
+    async def new_path(raw):
+        async for _, data in iter_sse_events(chunks(raw)):
+            if data[:1] == b"{":
+                json_utils.loads(data)
+
+    async def measure(func, raw):
+        start = time.perf_counter()
+        for _ in range(iterations):
+            await func(raw)
+        return (time.perf_counter() - start) / iterations
+
+    for name, raw in generate_sse_streams(events).items():
+        results = []
+        for label, func in (("aiter_lines + json.loads", old_path), ("iter_sse_events + decode", new_path)):
+            elapsed = asyncio.run(measure(func, raw))
+            results.append(f"{label}: {elapsed / events * 1e6:.2f}us/event, {len(raw) / elapsed / 1e6:.0f}MB/s")
+        print(f"{name:7} {len(raw) / 1e6:.1f}MB " + " | ".join(results))
+
+
+def load_image_corpus(path):
+    """Images under `path`, or a generated set covering every parsed format"""
+    import io
+
+    from PIL import Image
+
+    if path:
+        corpus = []
+        for root, _, files in os.walk(path):
+            for name in sorted(files):
+                with open(os.path.join(root, name), "rb") as f:
+                    corpus.append((name, f.read()))
+        return corpus
+
+    corpus = []
+    for width, height in ((64, 64), (1024, 768), (4032, 3024)):
+        image = Image.radial_gradient("L").resize((width, height)).convert("RGB")
+        for fmt, options in (
+            ("PNG", {}), ("JPEG", {"progressive": True, "exif": b"Exif\x00\x00" + b"\x00" * 4096}), ("GIF", {}),
+            ("WEBP", {}), ("WEBP", {"lossless": True}),
+        ):
+            buffer = io.BytesIO()
+            image.save(buffer, fmt, **options)
+            corpus.append((f"{width}x{height}.{fmt.lower()}{'-lossless' if options.get('lossless') else ''}",
+                           buffer.getvalue()))
+    return corpus
+
+
+def benchmark_images(iterations, path=None):
+    """Report per-image cost of reading dimensions with PIL vs the header parser"""
+    import io
+
+    from PIL import Image
+
+    from api.files import HEAD_SIZE, parse_image_size
+
+    def pil_size(data):
+        with Image.open(io.BytesIO(data)) as img:
+            return img.width, img.height
+
+    for name, data in load_image_corpus(path):
+        expected = pil_size(data)
+        head = data[:HEAD_SIZE]
+        results = []
+        for label, func, arg in (("PIL", pil_size, data), ("header", parse_image_size, head)):
+            start = time.perf_counter()
+            for _ in range(iterations):
+                size = func(arg)
+            results.append(f"{label}: {(time.perf_counter() - start) / iterations * 1e6:.2f}us")
+        match = "ok" if size == expected else f"fallback to PIL (parsed {size})"
+        print(f"{name:28} {expected[0]:>5}x{expected[1]:<5} " + " | ".join(results) + f" | {match}")
+
+
+def run_benchmark(args):
+    """Run a micro benchmark"""
+    if args.target == "json":
+        benchmark_json(args.iterations or 10000)
+    elif args.target == "tokenizer":
+        benchmark_tokenizer(args.iterations or 5)
+    elif args.target == "sse":
+        benchmark_sse(args.iterations or 5)
+    elif args.target == "images":
+        benchmark_images(args.iterations or 1000, args.path)
+
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Chat2API Management Tool")
@@ -90,6 +295,12 @@ if __name__ == "__main__":
     admin_parser.add_argument("--email", required=True, help="Admin email")
     admin_parser.add_argument("--password", required=True, help="Admin password")
     
+    # Command: python manage.py benchmark
+    benchmark_parser = subparsers.add_parser("benchmark", help="Run a micro benchmark")
+    benchmark_parser.add_argument("target", choices=["json", "tokenizer", "sse", "images"], help="Benchmark target")
+    benchmark_parser.add_argument("--iterations", "-n", type=int, help="Iterations per case")
+    benchmark_parser.add_argument("--path", help="Directory of images for the images benchmark")
+
     args = parser.parse_args()
     
     if args.action == "migration":
@@ -98,5 +309,7 @@ if __name__ == "__main__":
         run_initdb(args)
     elif args.action == "createadmin":
         create_admin_user(args.name, args.email, args.password)
+    elif args.action == "benchmark":
+        run_benchmark(args)
     else:
         parser.print_help()
@@ -0,0 +1,86 @@
+import os
+import random
+
+import pytest
+import tiktoken
+
+os.environ.setdefault("DATABASE_URL", "sqlite://")
+
+from api import tokens  # noqa: E402
+from api.tokens import PRE_TOKENIZER_PATTERNS, StreamTokenCounter  # noqa: E402
+
+SAMPLE = ("def f(x):\n    return  (x + 12345)  # it's\n\t\n  的一是不了，人我在有。 Hello  World's 1a!!\r\n"
+          "    if  1:  pass\n\n\n  ")
+
+
+def fake_encoding(name):
+    """A real pre-tokenizer with a small vocabulary, so the tests need no BPE download."""
+    sample = SAMPLE.encode()
+    ranks = {bytes([i]): i for i in range(256)}
+    for size in (2, 3, 4):
+        for i in range(len(sample) - size + 1):
+            piece = sample[i:i + size]
+            if piece[:-1] in ranks:
+                ranks.setdefault(piece, len(ranks))
+    return tiktoken.Encoding(name=name, pat_str=PRE_TOKENIZER_PATTERNS[name],
+                             mergeable_ranks=ranks, special_tokens={})
+
+
+@pytest.fixture(params=["cl100k_base", "o200k_base"])
+def encoding(request, monkeypatch):
+    encoding = fake_encoding(request.param)
+    monkeypatch.setattr(tokens, "get_encoding", lambda model=None: encoding)
+    return encoding
+
+
+def stream_count(deltas, **kwargs):
+    counter = StreamTokenCounter(**kwargs)
+    for delta in deltas:
+        counter.add(delta)
+    return counter.count
+
+
+def full_count(encoding, deltas):
+    return len(encoding.encode("".join(deltas), disallowed_special=()))
+
+
+@pytest.mark.parametrize("deltas", [
+    [" ", " 1a"],
+    ["x", "  ", "1"],
+    ["if", "\n    ", "("],
+    ["a", "\n", "\n", "  ", "b"],
+    ["foo", "  ", "  ", "\t", "bar's"],
+])
+def test_whitespace_before_boundary(encoding, deltas):
+    assert stream_count(deltas) == full_count(encoding, deltas)
+
+
+def test_random_splits_match_full_encode(encoding):
+    rng = random.Random(0)
+    alphabet = list(SAMPLE) + [" ", " ", "\n", "1"]
+    for _ in range(300):
+        text = "".join(rng.choice(alphabet) for _ in range(rng.randint(1, 200)))
+        deltas = []
+        while text:
+            size = rng.randint(1, 6)
+            deltas.append(text[:size])
+            text = text[size:]
+        assert stream_count(deltas) == full_count(encoding, deltas)
+
+
+def test_long_stream_keeps_pending_short(encoding):
+    deltas = [SAMPLE[i:i + 3] for i in range(0, len(SAMPLE), 3)] * 50
+    counter = StreamTokenCounter()
+    for delta in deltas:
+        counter.add(delta)
+        assert len(counter.pending) <= StreamTokenCounter.max_pending + 3
+    assert counter.count == full_count(encoding, deltas)
+
+
+def test_max_tokens_truncates(encoding):
+    deltas = [SAMPLE[i:i + 5] for i in range(0, len(SAMPLE), 5)]
+    counter = StreamTokenCounter(max_tokens=20)
+    allowed = "".join(counter.add(delta) for delta in deltas)
+    assert counter.exhausted
+    assert counter.count == 20
+    assert len(encoding.encode(allowed, disallowed_special=())) == 20
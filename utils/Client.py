@@ -1,13 +1,45 @@
-import random
+import asyncio
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
 
+from curl_cffi import AsyncCurl
 from curl_cffi.requests import AsyncSession
 
+from utils.configs import client_pool_idle_timeout, client_pool_max_size, stream_max_buffer
+from utils.Logger import logger
+from utils.sse import SlowConsumerError
+
+
+class SharedCurlSession(AsyncSession):
+    """An AsyncSession on a curl multi handle owned by someone else.
+
+    Closing it frees its own easy handles, including in-flight ones as they
+    are released, but leaves the shared multi handle running for the other
+    sessions on it.
+    """
+
+    async def close(self):
+        self._closed = True
+        while not self.pool.empty():
+            curl = self.pool.get_nowait()
+            if curl:
+                curl.close()
+
+    def release_curl(self, curl):
+        if self._closed:
+            # The shared multi handle outlives us and must not keep a freed handle
+            self.acurl.remove_handle(curl)
+        super().release_curl(curl)
+
 
 class Client:
-    def __init__(self, proxy=None, timeout=15, verify=True, impersonate='safari15_3'):
+    def __init__(self, proxy=None, timeout=15, verify=True, impersonate='safari15_3', async_curl=None):
         self.proxies = {"http": proxy, "https": proxy}
         self.timeout = timeout
         self.verify = verify
+        # A shared curl multi handle carries pooled connections; it is not ours to close
+        self.async_curl = async_curl
 
         self.impersonate = impersonate
         # impersonate=self.impersonate
@@ -15,8 +47,9 @@ class Client:
         # self.ja3 = ""
         # self.akamai = ""
         # ja3=self.ja3, akamai=self.akamai
-        self.session = AsyncSession(proxies=self.proxies, timeout=self.timeout, impersonate=self.impersonate, verify=self.verify)
-        self.session2 = AsyncSession(proxies=self.proxies, timeout=self.timeout, impersonate=self.impersonate, verify=self.verify)
+        session_class = AsyncSession if async_curl is None else SharedCurlSession
+        self.session = session_class(proxies=self.proxies, timeout=self.timeout, impersonate=self.impersonate, verify=self.verify, async_curl=async_curl)
+        self.session2 = session_class(proxies=self.proxies, timeout=self.timeout, impersonate=self.impersonate, verify=self.verify, async_curl=async_curl)
 
     async def post(self, *args, **kwargs):
         r = await self.session.post(*args, **kwargs)
@@ -54,3 +87,144 @@ class Client:
                 del self.session2
             except Exception:
                 pass
+
+
+class ClientPool:
+    """Process-wide registry of curl multi handles keyed by (proxy, impersonate).
+
+    Every borrower gets its own Client, with its own cookie jar, built on the
+    pooled multi handle, so it reuses the keep-alive connections instead of
+    paying a new TCP+TLS handshake per request without seeing another
+    account's cookies. Idle entries are evicted after `idle_timeout` seconds
+    and the registry never holds more than `max_size` entries; when it is
+    full and nothing is idle, an unpooled Client is handed out and closed on
+    release.
+    """
+
+    def __init__(self, max_size=64, idle_timeout=300):
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self._entries = OrderedDict()
+        self._borrowed = {}
+        self._overflow = set()
+        self._lock = asyncio.Lock()
+        self._sweeper = None
+
+    async def acquire(self, proxy=None, impersonate='safari15_3'):
+        key = (proxy, impersonate)
+        async with self._lock:
+            await self._evict_idle()
+            entry = self._entries.get(key)
+            if entry is None:
+                if len(self._entries) >= self.max_size and not await self._evict_lru():
+                    client = Client(proxy=proxy, impersonate=impersonate)
+                    self._overflow.add(client)
+                    return client
+                entry = {"async_curl": AsyncCurl(loop=asyncio.get_running_loop()), "refs": 0, "last_used": 0}
+                self._entries[key] = entry
+            self._entries.move_to_end(key)
+            entry["refs"] += 1
+            entry["last_used"] = time.monotonic()
+            client = Client(proxy=proxy, impersonate=impersonate, async_curl=entry["async_curl"])
+            self._borrowed[client] = key
+            return client
+
+    async def release(self, client):
+        if client is None:
+            return
+        if client in self._overflow:
+            self._overflow.discard(client)
+            await client.close()
+            return
+        async with self._lock:
+            key = self._borrowed.pop(client, None)
+            entry = self._entries.get(key)
+            if entry is not None and entry["async_curl"] is client.async_curl:
+                entry["refs"] = max(entry["refs"] - 1, 0)
+                entry["last_used"] = time.monotonic()
+        await client.close()
+
+    @asynccontextmanager
+    async def borrow(self, proxy=None, impersonate='safari15_3'):
+        client = await self.acquire(proxy, impersonate)
+        try:
+            yield client
+        finally:
+            await self.release(client)
+
+    async def _evict_idle(self):
+        now = time.monotonic()
+        for key, entry in list(self._entries.items()):
+            if entry["refs"] == 0 and now - entry["last_used"] > self.idle_timeout:
+                del self._entries[key]
+                await entry["async_curl"].close()
+
+    async def _evict_lru(self):
+        for key, entry in self._entries.items():
+            if entry["refs"] == 0:
+                del self._entries[key]
+                await entry["async_curl"].close()
+                return True
+        return False
+
+    async def _sweep(self):
+        while True:
+            await asyncio.sleep(max(self.idle_timeout // 2, 1))
+            try:
+                async with self._lock:
+                    await self._evict_idle()
+            except Exception as e:
+                logger.error(f"Client pool sweep failed: {e}")
+
+    def start(self):
+        if self._sweeper is None:
+            self._sweeper = asyncio.create_task(self._sweep())
+
+    async def close(self):
+        if self._sweeper:
+            self._sweeper.cancel()
+            self._sweeper = None
+        async with self._lock:
+            entries = list(self._entries.values())
+            self._entries.clear()
+        for entry in entries:
+            await entry["async_curl"].close()
+        for client in list(self._overflow):
+            await client.close()
+        self._overflow.clear()
+
+    def stats(self):
+        return {
+            "size": len(self._entries),
+            "max_size": self.max_size,
+            "in_use": sum(1 for entry in self._entries.values() if entry["refs"] > 0),
+            "borrowed": len(self._borrowed),
+            "overflow": len(self._overflow),
+        }
+
+
+client_pool = ClientPool(max_size=client_pool_max_size, idle_timeout=client_pool_idle_timeout)
+
+
+def abort_response(r):
+    """Stop a streaming response without waiting for the rest of the body.
+
+    curl_cffi's `aclose` awaits the whole transfer; setting `quit_now` makes
+    the next write callback fail so curl drops the connection instead.
+    """
+    quit_now = getattr(r, "quit_now", None)
+    if quit_now is not None and not quit_now.is_set():
+        quit_now.set()
+
+
+async def iter_stream(r, max_buffer=stream_max_buffer):
+    """Iterate a streaming response, aborting it if the reader falls behind.
+
+    curl pushes every received chunk into an unbounded queue, so a client that
+    reads slower than upstream writes would grow it without limit.
+    """
+    async for chunk in r.aiter_content():
+        yield chunk
+        if max_buffer and r.queue is not None and r.queue.qsize() > max_buffer:
+            abort_response(r)
+            raise SlowConsumerError(f"more than {max_buffer} upstream chunks buffered")
@@ -52,6 +52,7 @@ check_model = is_true(os.getenv('CHECK_MODEL', False))
 scheduled_refresh = is_true(os.getenv('SCHEDULED_REFRESH', False))
 random_token = is_true(os.getenv('RANDOM_TOKEN', True))
 oai_language = os.getenv('OAI_LANGUAGE', 'zh-CN')
+delta_encoding = is_true(os.getenv('DELTA_ENCODING', True))
 
 authorization_list = authorization.split(',') if authorization else []
 chatgpt_base_url_list = chatgpt_base_url.split(',') if chatgpt_base_url else []
@@ -69,6 +70,47 @@ auto_seed = is_true(os.getenv('AUTO_SEED', True))
 force_no_history = is_true(os.getenv('FORCE_NO_HISTORY', False))
 no_sentinel = is_true(os.getenv('NO_SENTINEL', False))
 
+client_pool_max_size = int(os.getenv('CLIENT_POOL_MAX_SIZE', 64))
+client_pool_idle_timeout = int(os.getenv('CLIENT_POOL_IDLE_TIMEOUT', 300))
+prewarm_connections = int(os.getenv('PREWARM_CONNECTIONS', 0))
+keep_alive_interval = int(os.getenv('KEEP_ALIVE_INTERVAL', 60))
+host_eject_failures = int(os.getenv('HOST_EJECT_FAILURES', 3))
+host_eject_cooldown = int(os.getenv('HOST_EJECT_COOLDOWN', 30))
+hedge_requests = is_true(os.getenv('HEDGE_REQUESTS', False))
+hedge_percentile = int(os.getenv('HEDGE_PERCENTILE', 95))
+tiktoken_cache_dir = os.getenv('TIKTOKEN_CACHE_DIR', 'tiktoken_cache')
+token_cache_size = int(os.getenv('TOKEN_CACHE_SIZE', 4096))
+tokenizer_workers = int(os.getenv('TOKENIZER_WORKERS', 2))
+tokenizer_offload_threshold = int(os.getenv('TOKENIZER_OFFLOAD_THRESHOLD', 32768))
+sse_coalesce_bytes = int(os.getenv('SSE_COALESCE_BYTES', 0))
+sse_coalesce_interval = int(os.getenv('SSE_COALESCE_INTERVAL', 20))
+stream_max_buffer = int(os.getenv('STREAM_MAX_BUFFER', 1024))
+attachment_url_ttl = int(os.getenv('ATTACHMENT_URL_TTL', 300))
+resumable_streams = is_true(os.getenv('RESUMABLE_STREAMS', False))
+resumable_stream_ttl = int(os.getenv('RESUMABLE_STREAM_TTL', 300))
+resumable_stream_max_events = int(os.getenv('RESUMABLE_STREAM_MAX_EVENTS', 4096))
+resumable_stream_max_bytes = int(os.getenv('RESUMABLE_STREAM_MAX_BYTES', 64 * 1024 * 1024))
+single_flight = is_true(os.getenv('SINGLE_FLIGHT', False))
+response_cache = is_true(os.getenv('RESPONSE_CACHE', False))
+response_cache_ttl = int(os.getenv('RESPONSE_CACHE_TTL', 3600))
+response_cache_size = int(os.getenv('RESPONSE_CACHE_SIZE', 256))
+response_cache_disk_size = int(os.getenv('RESPONSE_CACHE_DISK_SIZE', 256 * 1024 * 1024))
+response_cache_max_item_size = int(os.getenv('RESPONSE_CACHE_MAX_ITEM_SIZE', 1024 * 1024))
+conversation_cache = is_true(os.getenv('CONVERSATION_CACHE', False))
+conversation_cache_size = int(os.getenv('CONVERSATION_CACHE_SIZE', 1024))
+conversation_cache_ttl = int(os.getenv('CONVERSATION_CACHE_TTL', 3600))
+upload_concurrency = int(os.getenv('UPLOAD_CONCURRENCY', 4))
+upload_cache = is_true(os.getenv('UPLOAD_CACHE', False))
+upload_cache_ttl = int(os.getenv('UPLOAD_CACHE_TTL', 86400))
+upload_cache_size = int(os.getenv('UPLOAD_CACHE_SIZE', 64 * 1024 * 1024))
+upload_max_size = int(os.getenv('UPLOAD_MAX_SIZE', 100 * 1024 * 1024))
+upload_spool_size = int(os.getenv('UPLOAD_SPOOL_SIZE', 1024 * 1024))
+upload_block_size = int(os.getenv('UPLOAD_BLOCK_SIZE', 4 * 1024 * 1024))
+image_resize = is_true(os.getenv('IMAGE_RESIZE', False))
+image_resize_workers = int(os.getenv('IMAGE_RESIZE_WORKERS', 2))
+image_resize_quality = int(os.getenv('IMAGE_RESIZE_QUALITY', 85))
+image_resize_min_bytes = int(os.getenv('IMAGE_RESIZE_MIN_BYTES', 256 * 1024))
+
 # Pipelines 相關配置
 pipeline_enable = is_true(os.getenv('PIPELINE_ENABLE', False))
 pipeline_api_url = os.getenv('PIPELINE_API_URL', '')
@@ -93,6 +135,46 @@ logger.info("FILE_HOST:     " + str(file_host))
 logger.info("VOICE_HOST:    " + str(voice_host))
 logger.info("IMPERSONATE:       " + str(impersonate_list))
 logger.info("USER_AGENTS:       " + str(user_agents_list))
+logger.info("CLIENT_POOL_MAX_SIZE:     " + str(client_pool_max_size))
+logger.info("CLIENT_POOL_IDLE_TIMEOUT: " + str(client_pool_idle_timeout))
+logger.info("PREWARM_CONNECTIONS:      " + str(prewarm_connections))
+logger.info("KEEP_ALIVE_INTERVAL:      " + str(keep_alive_interval))
+logger.info("HOST_EJECT_FAILURES:      " + str(host_eject_failures))
+logger.info("HOST_EJECT_COOLDOWN:      " + str(host_eject_cooldown))
+logger.info("HEDGE_REQUESTS:           " + str(hedge_requests))
+logger.info("HEDGE_PERCENTILE:         " + str(hedge_percentile))
+logger.info("TIKTOKEN_CACHE_DIR:       " + str(tiktoken_cache_dir))
+logger.info("TOKEN_CACHE_SIZE:         " + str(token_cache_size))
+logger.info("TOKENIZER_WORKERS:        " + str(tokenizer_workers))
+logger.info("TOKENIZER_OFFLOAD_THRESHOLD: " + str(tokenizer_offload_threshold))
+logger.info("SSE_COALESCE_BYTES:       " + str(sse_coalesce_bytes))
+logger.info("SSE_COALESCE_INTERVAL:    " + str(sse_coalesce_interval))
+logger.info("STREAM_MAX_BUFFER:        " + str(stream_max_buffer))
+logger.info("ATTACHMENT_URL_TTL:       " + str(attachment_url_ttl))
+logger.info("RESUMABLE_STREAMS:        " + str(resumable_streams))
+logger.info("RESUMABLE_STREAM_TTL:     " + str(resumable_stream_ttl))
+logger.info("RESUMABLE_STREAM_MAX_EVENTS: " + str(resumable_stream_max_events))
+logger.info("RESUMABLE_STREAM_MAX_BYTES:  " + str(resumable_stream_max_bytes))
+logger.info("SINGLE_FLIGHT:            " + str(single_flight))
+logger.info("RESPONSE_CACHE:           " + str(response_cache))
+logger.info("RESPONSE_CACHE_TTL:       " + str(response_cache_ttl))
+logger.info("RESPONSE_CACHE_SIZE:      " + str(response_cache_size))
+logger.info("RESPONSE_CACHE_DISK_SIZE: " + str(response_cache_disk_size))
+logger.info("RESPONSE_CACHE_MAX_ITEM_SIZE: " + str(response_cache_max_item_size))
+logger.info("CONVERSATION_CACHE:       " + str(conversation_cache))
+logger.info("CONVERSATION_CACHE_SIZE:  " + str(conversation_cache_size))
+logger.info("CONVERSATION_CACHE_TTL:   " + str(conversation_cache_ttl))
+logger.info("UPLOAD_CONCURRENCY:       " + str(upload_concurrency))
+logger.info("UPLOAD_CACHE:             " + str(upload_cache))
+logger.info("UPLOAD_CACHE_TTL:         " + str(upload_cache_ttl))
+logger.info("UPLOAD_CACHE_SIZE:        " + str(upload_cache_size))
+logger.info("UPLOAD_MAX_SIZE:          " + str(upload_max_size))
+logger.info("UPLOAD_SPOOL_SIZE:        " + str(upload_spool_size))
+logger.info("UPLOAD_BLOCK_SIZE:        " + str(upload_block_size))
+logger.info("IMAGE_RESIZE:             " + str(image_resize))
+logger.info("IMAGE_RESIZE_WORKERS:     " + str(image_resize_workers))
+logger.info("IMAGE_RESIZE_QUALITY:     " + str(image_resize_quality))
+logger.info("IMAGE_RESIZE_MIN_BYTES:   " + str(image_resize_min_bytes))
 logger.info("---------------------- Functionality -----------------------")
 logger.info("HISTORY_DISABLED:  " + str(history_disabled))
 logger.info("POW_DIFFICULTY:    " + str(pow_difficulty))
@@ -104,6 +186,7 @@ logger.info("CHECK_MODEL:       " + str(check_model))
 logger.info("SCHEDULED_REFRESH: " + str(scheduled_refresh))
 logger.info("RANDOM_TOKEN:      " + str(random_token))
 logger.info("OAI_LANGUAGE:      " + str(oai_language))
+logger.info("DELTA_ENCODING:    " + str(delta_encoding))
 logger.info("------------------------- Gateway --------------------------")
 logger.info("ENABLE_GATEWAY:    " + str(enable_gateway))
 logger.info("AUTO_SEED:         " + str(auto_seed))
@@ -0,0 +1,35 @@
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+backend = "orjson" if orjson else "json"
+
+
+def stdlib_loads(data):
+    if isinstance(data, memoryview):
+        data = data.tobytes()
+    return json.loads(data)
+
+
+def stdlib_dumps(obj):
+    return json.dumps(obj, separators=(',', ':'), ensure_ascii=False)
+
+
+def orjson_loads(data):
+    return orjson.loads(data)
+
+
+def orjson_dumps(obj):
+    return orjson.dumps(obj).decode('utf-8')
+
+
+# Both backends produce the same compact, non-ASCII-escaped output
+loads = orjson_loads if orjson else stdlib_loads
+dumps = orjson_dumps if orjson else stdlib_dumps
+
+backends = {"json": (stdlib_loads, stdlib_dumps)}
+if orjson:
+    backends["orjson"] = (orjson_loads, orjson_dumps)
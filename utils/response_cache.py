@@ -0,0 +1,141 @@
+import hashlib
+import json
+import time
+from collections import OrderedDict
+
+import diskcache as dc
+from starlette.concurrency import run_in_threadpool
+
+from utils.configs import (
+    response_cache,
+    response_cache_disk_size,
+    response_cache_max_item_size,
+    response_cache_size,
+    response_cache_ttl,
+)
+from utils.Logger import logger
+
+
+class ResponseCache:
+    """Exact-match cache of completions, in memory with a diskcache tier behind it.
+
+    Entries are keyed by a canonical hash of the caller token, model, messages
+    and the parameters that change the output shape. Non-stream requests cache the
+    `chat.completion` object; stream requests cache the emitted SSE events
+    and replay them verbatim. Only streams that reach `[DONE]` are stored.
+    """
+
+    def __init__(self, enabled=False, ttl=3600, max_size=256, disk_size=256 * 1024 * 1024, max_item_size=1024 * 1024,
+                 directory='./data/response_cache'):
+        self.enabled = enabled
+        self.ttl = ttl
+        self.max_size = max_size
+        self.disk_size = disk_size
+        self.max_item_size = max_item_size
+        self.directory = directory
+        self._entries = OrderedDict()
+        self._disk = None
+        self.metrics = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "stores": 0}
+
+    @property
+    def disk(self):
+        if self._disk is None and self.disk_size > 0:
+            self._disk = dc.Cache(self.directory, size_limit=self.disk_size)
+        return self._disk
+
+    def is_enabled(self, headers):
+        flag = headers.get("x-response-cache")
+        if flag is None:
+            return self.enabled
+        return flag.lower() in ("true", "1", "yes", "on")
+
+    @staticmethod
+    def key(req_token, request_data):
+        payload = {
+            "token": req_token,
+            "model": request_data.get("model"),
+            "messages": request_data.get("messages"),
+            "max_tokens": request_data.get("max_tokens"),
+            "stream": bool(request_data.get("stream")),
+            "stream_options": request_data.get("stream_options"),
+        }
+        return hashlib.sha256(json.dumps(payload, sort_keys=True, ensure_ascii=False).encode()).hexdigest()
+
+    async def get(self, key):
+        entry = self._entries.get(key)
+        if entry is not None:
+            expires_at, value = entry
+            if expires_at > time.time():
+                self._entries.move_to_end(key)
+                self.metrics["memory_hits"] += 1
+                return value
+            del self._entries[key]
+        if self.disk is not None:
+            try:
+                value, expires_at = await run_in_threadpool(self.disk.get, key, None, expire_time=True)
+            except Exception as e:
+                logger.warning(f"Response cache read failed: {e}")
+                value = None
+            if value is not None:
+                self._remember(key, value, expires_at or time.time() + self.ttl)
+                self.metrics["disk_hits"] += 1
+                return value
+        self.metrics["misses"] += 1
+        return None
+
+    async def set(self, key, value):
+        self.metrics["stores"] += 1
+        self._remember(key, value, time.time() + self.ttl)
+        if self.disk is not None:
+            try:
+                await run_in_threadpool(self.disk.set, key, value, expire=self.ttl)
+            except Exception as e:
+                logger.warning(f"Response cache write failed: {e}")
+
+    def _remember(self, key, value, expires_at):
+        if self.max_size <= 0:
+            return
+        self._entries[key] = (expires_at, value)
+        self._entries.move_to_end(key)
+        if len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    async def record(self, key, chunks):
+        """Pass a stream through, storing its events once it completes."""
+        events = []
+        size = 0
+        async for chunk in chunks:
+            if events is not None:
+                events.append(chunk)
+                size += len(chunk)
+                if size > self.max_item_size:
+                    events = None
+            yield chunk
+        if events and "[DONE]" in events[-1]:
+            await self.set(key, events)
+
+    @staticmethod
+    async def replay(events):
+        for event in events:
+            yield event
+
+    async def purge(self):
+        purged = {"memory": len(self._entries), "disk": 0}
+        self._entries.clear()
+        if self.disk is not None:
+            purged["disk"] = await run_in_threadpool(self.disk.clear)
+        return purged
+
+    def stats(self):
+        lookups = self.metrics["memory_hits"] + self.metrics["disk_hits"] + self.metrics["misses"]
+        hits = lookups - self.metrics["misses"]
+        return {
+            "enabled": self.enabled,
+            "memory_entries": len(self._entries),
+            "hit_rate": round(hits / lookups, 4) if lookups else 0.0,
+            **self.metrics,
+        }
+
+
+response_cache = ResponseCache(response_cache, response_cache_ttl, response_cache_size, response_cache_disk_size,
+                               response_cache_max_item_size)
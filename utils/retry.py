@@ -10,7 +10,8 @@ async def async_retry(func, *args, max_retries=retry_times, **kwargs):
             result = await func(*args, **kwargs)
             return result
         except HTTPException as e:
-            if attempt == max_retries:
+            # An oversized attachment stays oversized, do not fetch it again
+            if attempt == max_retries or e.status_code == 413:
                 logger.error(f"Throw an exception {e.status_code}, {e.detail}")
                 if e.status_code == 500:
                     raise HTTPException(status_code=500, detail="Server error")
@@ -0,0 +1,168 @@
+import asyncio
+
+from utils.Logger import logger
+
+
+async def iter_sse_events(chunks):
+    """Frame a byte stream into server-sent events without decoding it.
+
+    Yields `(event, data)` for every event terminated by a blank line (or by
+    the end of the stream). `event` is the raw event name (b"" when absent).
+    A single-line `data` field, the common case, is a memoryview over the
+    received bytes so the payload reaches the JSON decoder without a copy.
+    Multi-line data is joined with b"\\n" as the SSE spec requires. Lines may
+    be split across chunks and end with either LF or CRLF.
+    """
+    pending = b""
+    event = b""
+    data_lines = []
+    async for chunk in chunks:
+        if not chunk:
+            continue
+        # `pending` never holds a newline, so only the new bytes need scanning
+        scan_from = len(pending)
+        buffer = pending + chunk if pending else bytes(chunk)
+        view = memoryview(buffer)
+        start = 0
+        while True:
+            end = buffer.find(b"\n", max(start, scan_from))
+            if end == -1:
+                break
+            line_end = end - 1 if end > start and buffer[end - 1] == 13 else end
+            if line_end == start:
+                if data_lines:
+                    yield event, data_lines[0] if len(data_lines) == 1 else b"\n".join(data_lines)
+                event = b""
+                data_lines = []
+            elif buffer.startswith(b"data:", start):
+                value_start = start + 6 if buffer.startswith(b" ", start + 5) else start + 5
+                data_lines.append(view[value_start:line_end])
+            elif buffer.startswith(b"event:", start):
+                event = buffer[start + 6:line_end].strip()
+            start = end + 1
+        pending = buffer[start:]
+    if pending:
+        line = pending.rstrip(b"\r")
+        if line.startswith(b"data:"):
+            data_lines.append(memoryview(line)[6 if line.startswith(b"data: ") else 5:])
+    if data_lines:
+        yield event, data_lines[0] if len(data_lines) == 1 else b"\n".join(data_lines)
+
+
+async def coalesce_sse(chunks, max_bytes=4096, max_delay=0.02):
+    """Batch small SSE writes into fewer, larger ones.
+
+    Chunks are buffered until `max_bytes` is reached or the oldest buffered
+    chunk has waited `max_delay` seconds, even if the source is idle. The
+    first chunk and `[DONE]` are always flushed immediately so time-to-first-
+    byte and stream completion are never delayed.
+    """
+    loop = asyncio.get_running_loop()
+    iterator = chunks.__aiter__()
+    buffer = []
+    size = 0
+    deadline = 0
+    first = True
+    pending = None
+    try:
+        while True:
+            if pending is None:
+                pending = asyncio.ensure_future(iterator.__anext__())
+            if buffer:
+                timeout = deadline - loop.time()
+                done = (await asyncio.wait({pending}, timeout=timeout))[0] if timeout > 0 else ()
+                if not done:
+                    yield "".join(buffer)
+                    buffer = []
+                    size = 0
+                    continue
+            try:
+                chunk = await pending
+            except StopAsyncIteration:
+                break
+            finally:
+                if pending.done():
+                    pending = None
+            if first or "[DONE]" in chunk:
+                first = False
+                buffer.append(chunk)
+                yield "".join(buffer)
+                buffer = []
+                size = 0
+                continue
+            if not buffer:
+                deadline = loop.time() + max_delay
+            buffer.append(chunk)
+            size += len(chunk)
+            if size >= max_bytes:
+                yield "".join(buffer)
+                buffer = []
+                size = 0
+        if buffer:
+            yield "".join(buffer)
+    finally:
+        if pending is not None:
+            pending.cancel()
+            try:
+                await pending
+            except (asyncio.CancelledError, Exception):
+                pass
+        if hasattr(iterator, "aclose"):
+            await iterator.aclose()
+
+
+class SlowConsumerError(Exception):
+    """Raised when a client falls too far behind the upstream stream."""
+
+
+class StreamTracker:
+    """Counts relayed streams by outcome for the status endpoint."""
+
+    def __init__(self):
+        self.active = 0
+        self.outcomes = {"completed": 0, "aborted": 0, "overflow": 0, "failed": 0}
+
+    def stats(self):
+        return {"active": self.active, **self.outcomes}
+
+
+stream_tracker = StreamTracker()
+
+
+async def guard_stream(chunks, on_abort=None):
+    """Relay `chunks` and tear the upstream down as soon as the client leaves.
+
+    A client disconnect surfaces either as a cancellation while waiting on the
+    upstream or as the generator being closed at a `yield`; both call
+    `on_abort` synchronously (no awaiting inside a cancelled scope) and are
+    recorded as "aborted".
+    """
+    stream_tracker.active += 1
+    outcome = "aborted"
+    try:
+        async for chunk in chunks:
+            yield chunk
+        outcome = "completed"
+    except SlowConsumerError as e:
+        outcome = "overflow"
+        logger.warning(f"Stream aborted: {e}")
+    except (asyncio.CancelledError, GeneratorExit):
+        raise
+    except Exception:
+        outcome = "failed"
+        raise
+    finally:
+        stream_tracker.active -= 1
+        stream_tracker.outcomes[outcome] += 1
+        if outcome != "completed":
+            if on_abort:
+                on_abort()
+            if hasattr(chunks, "aclose"):
+                await chunks.aclose()
+
+
+async def close_stream(stream, *callbacks):
+    """Background task for streamed responses: close the body, then clean up."""
+    await stream.aclose()
+    for callback in callbacks:
+        await callback()
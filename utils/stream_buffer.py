@@ -0,0 +1,276 @@
+import asyncio
+import hashlib
+import json
+import time
+import types
+import uuid
+from collections import OrderedDict, deque
+
+from fastapi import HTTPException
+
+from utils.configs import (
+    resumable_stream_max_bytes,
+    resumable_stream_max_events,
+    resumable_stream_ttl,
+)
+from utils.configs import resumable_streams as resumable_streams_enabled
+from utils.configs import single_flight as single_flight_enabled
+from utils.Logger import logger
+
+
+class StreamBuffer:
+    """Bounded ring of the SSE events produced for one response.
+
+    The producer never waits for readers: each reader follows the ring at its
+    own pace and is cut off if it falls further behind than the ring holds.
+    With `abort_unread`, the producer is cancelled once its last reader leaves.
+    """
+
+    def __init__(self, stream_id, max_events, abort_unread=False, owner=None):
+        self.stream_id = stream_id
+        self.owner = owner
+        self.events = deque(maxlen=max_events)
+        self.abort_unread = abort_unread
+        self.next_seq = 0
+        self.size = 0
+        self.dropped = 0
+        self.readers = 0
+        self.done = False
+        self.task = None
+        self.expires_at = None
+        self._changed = asyncio.Event()
+
+    def start(self, source, on_finish, on_append=None, ttl=0):
+        self.task = asyncio.create_task(self.pump(source, on_finish, on_append, ttl))
+        return self
+
+    async def pump(self, source, on_finish, on_append=None, ttl=0):
+        try:
+            async for chunk in source:
+                grown, dropped = self.append(chunk)
+                if on_append:
+                    on_append(self, grown, dropped)
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            logger.error(f"Stream {self.stream_id} failed: {e}")
+        finally:
+            self.finish(ttl)
+            await on_finish()
+
+    def append(self, data):
+        """Add an event; returns (bytes grown, whether the oldest event was dropped)."""
+        grown = len(data)
+        dropped = len(self.events) == self.events.maxlen
+        if dropped:
+            grown -= len(self.events[0][1])
+            self.dropped += 1
+        self.events.append((self.next_seq, data))
+        self.next_seq += 1
+        self.size += grown
+        self._notify()
+        return grown, dropped
+
+    def finish(self, ttl):
+        self.done = True
+        self.expires_at = time.monotonic() + ttl
+        self._notify()
+
+    def _notify(self):
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    @property
+    def first_seq(self):
+        return self.events[0][0] if self.events else self.next_seq
+
+    async def follow(self, after_seq=-1):
+        """Yield `(seq, data)` for every event after `after_seq`, live until done."""
+        seq = after_seq + 1
+        self.readers += 1
+        try:
+            while True:
+                changed = self._changed
+                if seq < self.first_seq:
+                    logger.warning(f"Stream {self.stream_id}: reader fell behind the buffer, "
+                                   f"events {seq}-{self.first_seq - 1} lost")
+                    return
+                while seq < self.next_seq:
+                    yield seq, self.events[seq - self.first_seq][1]
+                    seq += 1
+                if self.done:
+                    return
+                await changed.wait()
+        finally:
+            self.readers -= 1
+            if self.readers == 0 and self.abort_unread and not self.done and self.task:
+                self.task.cancel()
+
+    async def relay(self, after_seq=-1, ids=True):
+        async for seq, data in self.follow(after_seq):
+            yield f"id: {self.stream_id}-{seq}\n{data}" if ids else data
+
+
+class ResumableStreams:
+    """Keeps recent chat streams replayable by `Last-Event-ID`.
+
+    The upstream generation is pumped into a StreamBuffer by its own task, so
+    a dropped downstream connection does not stop it; a client that comes
+    back with `Last-Event-ID: <stream_id>-<seq>` and the same token gets the
+    missed events and then follows the live stream. Finished buffers live for
+    `ttl` seconds and the total buffered size is capped at `max_bytes`,
+    evicting the oldest streams (cancelling their upstream if still running)
+    first.
+    """
+
+    def __init__(self, enabled=False, ttl=300, max_events=4096, max_bytes=64 * 1024 * 1024):
+        self.enabled = enabled
+        self.ttl = ttl
+        self.max_events = max_events
+        self.max_bytes = max_bytes
+        self.streams = OrderedDict()
+        self.total_bytes = 0
+        self.metrics = {"created": 0, "resumed": 0, "resume_misses": 0, "evicted_expired": 0, "evicted_memory": 0,
+                        "dropped_events": 0}
+
+    def start(self, source, on_finish, owner=None):
+        self._evict_expired()
+        buffer = StreamBuffer(uuid.uuid4().hex, self.max_events, owner=owner)
+        self.streams[buffer.stream_id] = buffer
+        self.metrics["created"] += 1
+        return buffer.start(source, on_finish, self._account, self.ttl)
+
+    def _account(self, buffer, grown, dropped):
+        self.metrics["dropped_events"] += dropped
+        if buffer.stream_id in self.streams:
+            self.total_bytes += grown
+            self._evict_oversize()
+
+    def resume(self, last_event_id, owner=None):
+        self._evict_expired()
+        stream_id, _, seq = last_event_id.strip().rpartition("-")
+        buffer = self.streams.get(stream_id)
+        # Someone else's stream is reported the same as a missing one
+        if buffer is None or buffer.owner != owner or not seq.isdigit():
+            self.metrics["resume_misses"] += 1
+            raise HTTPException(status_code=404, detail="Stream not found or expired")
+        if int(seq) + 1 < buffer.first_seq:
+            self.metrics["resume_misses"] += 1
+            raise HTTPException(status_code=410, detail="Stream events are no longer buffered")
+        self.metrics["resumed"] += 1
+        return buffer.relay(int(seq))
+
+    def _evict(self, stream_id, reason):
+        buffer = self.streams.pop(stream_id)
+        self.total_bytes -= buffer.size
+        self.metrics[reason] += 1
+        if not buffer.done and buffer.task:
+            buffer.task.cancel()
+
+    def _evict_expired(self):
+        now = time.monotonic()
+        for stream_id, buffer in list(self.streams.items()):
+            if buffer.done and buffer.expires_at <= now:
+                self._evict(stream_id, "evicted_expired")
+
+    def _evict_oversize(self):
+        if self.total_bytes <= self.max_bytes:
+            return
+        # Drop finished streams first, then the oldest running ones
+        candidates = [stream_id for stream_id, buffer in self.streams.items() if buffer.done]
+        candidates += [stream_id for stream_id, buffer in self.streams.items() if not buffer.done]
+        for stream_id in candidates:
+            if self.total_bytes <= self.max_bytes or len(self.streams) <= 1:
+                break
+            self._evict(stream_id, "evicted_memory")
+
+    def stats(self):
+        return {
+            "streams": len(self.streams),
+            "running": sum(1 for buffer in self.streams.values() if not buffer.done),
+            "bytes": self.total_bytes,
+            "max_bytes": self.max_bytes,
+            **self.metrics,
+        }
+
+
+resumable_streams = ResumableStreams(resumable_streams_enabled, resumable_stream_ttl, resumable_stream_max_events,
+                                     resumable_stream_max_bytes)
+
+
+class SingleFlight:
+    """Attaches identical in-flight completion requests to one upstream run.
+
+    The first request for a key runs the pipeline; later ones with the same
+    key await its outcome instead. Streams are pumped into a StreamBuffer that
+    every subscriber follows independently, and non-stream results are
+    shared as-is. Failures are not shared: followers then run on their own.
+    """
+
+    def __init__(self, enabled=False, max_events=4096):
+        self.enabled = enabled
+        self.max_events = max_events
+        self.inflight = {}
+        self.metrics = {"started": 0, "joined": 0}
+
+    @staticmethod
+    def key(req_token, request_data):
+        payload = json.dumps([req_token, request_data], sort_keys=True, ensure_ascii=False, default=str)
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    async def run(self, key, func, *args, owner=None):
+        """Returns a StreamBuffer for streams or the response dict otherwise."""
+        future = self.inflight.get(key)
+        if future is not None:
+            try:
+                result = await asyncio.shield(future)
+            except asyncio.CancelledError:
+                if asyncio.current_task().cancelling():
+                    raise
+                # The leader was cancelled, not this request
+                result = None
+            except Exception:
+                result = None
+            if isinstance(result, dict) or (isinstance(result, StreamBuffer) and result.first_seq == 0):
+                self.metrics["joined"] += 1
+                return result
+
+        future = asyncio.get_running_loop().create_future()
+        self.inflight[key] = future
+        self.metrics["started"] += 1
+        try:
+            chat_service, res = await func(*args)
+        except asyncio.CancelledError:
+            self._forget(key, future)
+            future.cancel()
+            raise
+        except BaseException as e:
+            self._forget(key, future)
+            future.set_exception(e)
+            # Followers fall back to their own run; never log the shared exception as unretrieved
+            future.exception()
+            raise
+
+        if isinstance(res, types.AsyncGeneratorType):
+            if resumable_streams.enabled:
+                result = resumable_streams.start(res, chat_service.close_client, owner)
+            else:
+                result = StreamBuffer(uuid.uuid4().hex, self.max_events, abort_unread=True, owner=owner)
+                result.start(res, chat_service.close_client)
+            result.task.add_done_callback(lambda _: self._forget(key, future))
+        else:
+            self._forget(key, future)
+            await chat_service.close_client()
+            result = res
+        future.set_result(result)
+        return result
+
+    def _forget(self, key, future):
+        if self.inflight.get(key) is future:
+            del self.inflight[key]
+
+    def stats(self):
+        return {"inflight": len(self.inflight), **self.metrics}
+
+
+single_flight = SingleFlight(single_flight_enabled, resumable_stream_max_events)